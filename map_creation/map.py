@@ -1,129 +1,215 @@
+import base64
+import gzip
+import hashlib
 import json
 import re
 import time
 import os
+import shutil
+import sqlite3
 import pandas as pd
 import requests
 import folium
-import math
 import googlemaps
+import ijson
 import numpy as np
+import orjson
+import pyarrow as pa
+from pyarrow import csv as pacsv
 from folium.plugins import HeatMap
-from collections import defaultdict
-from branca.element import Element
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from tqdm import tqdm
 
 # --- Configuration ---
 # File Paths
 RAW_JSON_FILENAME = "map_creation/fitzpatrick_usa_search.json"
+RAW_NDJSON_FILENAME = "map_creation/fitzpatrick_usa_search.ndjson"
+FINAL_MASTER_PARQUET = "map_creation/final_master_dataset.parquet"
 FINAL_MASTER_CSV = "map_creation/final_master_dataset.csv"
+EXPORT_MASTER_CSV = False # Also write the master dataset as CSV for older tooling
 MAP_OUTPUT_HTML = "index.html"
+MAP_DATA_JSON = "map_data.json" # Fetched by the map page at load time, so it must sit where the page can reach it
+WRITE_GZIP_COPIES = True # Also write precompressed .gz copies of the map page and its data for gzip-aware servers
+GEOCODE_CACHE_DB = "map_creation/geocode_cache.sqlite"
 
 # ClinicalTrials.gov API Settings
 API_BASE_URL = "https://clinicaltrials.gov/api/v2/studies"
 SEARCH_KEYWORD = 'fitzpatrick'
 COUNTRY_TO_ISOLATE = "United States"
+# Every study has exactly one overall status, so these partition the search into disjoint queries
+STUDY_STATUSES = [
+    'ACTIVE_NOT_RECRUITING', 'COMPLETED', 'ENROLLING_BY_INVITATION', 'NOT_YET_RECRUITING', 'RECRUITING',
+    'SUSPENDED', 'TERMINATED', 'WITHDRAWN', 'AVAILABLE', 'NO_LONGER_AVAILABLE', 'TEMPORARILY_NOT_AVAILABLE',
+    'APPROVED_FOR_MARKETING', 'WITHHELD', 'UNKNOWN'
+]
+FETCH_MAX_WORKERS = 8
+API_TIMEOUT = (3, 30) # (connect, read) seconds
+
+# Google Places API Settings
+GEOCODE_CACHE_TTL_DAYS = 30
+PLACES_MAX_WORKERS = 8
+PLACES_MAX_RETRIES = 3 # Extra attempts for quota and transport errors, with exponential backoff
 
 # --- 1. ClinicalTrials.gov Data Fetching ---
 
-def fetch_clinical_trials_data(api_url, keyword, output_filename):
-    """
-    Searches the ClinicalTrials.gov API for studies matching a keyword
-    and saves the raw results to a JSON file.
-    """
-    print(f"[*] Starting API query to fetch clinical trial data for keyword: '{keyword}'...")
-    all_studies = []
+def _create_api_session():
+    """Creates a pooled HTTP session that retries throttled or failed requests with backoff."""
+    retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_MAX_WORKERS, max_retries=retry))
+    return session
+
+API_SESSION = _create_api_session()
+
+def _fetch_study_pages(api_url, params, label):
+    """Follows the nextPageToken chain for a single query and returns its studies in page order."""
+    studies = []
     page_count = 1
     next_page_token = None
-    eligibility_search = f'AREA[EligibilityCriteria]({keyword}) AND SEARCH[Location](AREA[LocationCountry]"{COUNTRY_TO_ISOLATE}")'
-    fields_to_get = ["NCTId", "protocolSection", "resultsSection"]
-    params = {'query.term': eligibility_search, 'fields': ",".join(fields_to_get), 'pageSize': 100}
+    params = dict(params)
 
     while True:
         try:
             if next_page_token:
                 params['pageToken'] = next_page_token
-            response = requests.get(api_url, params=params)
+            response = API_SESSION.get(api_url, params=params, timeout=API_TIMEOUT)
             response.raise_for_status()
             data = response.json()
             current_studies = data.get('studies', [])
             if not current_studies: break
-            all_studies.extend(current_studies)
-            print(f"[*] Page {page_count}: Fetched {len(current_studies)} studies. Total so far: {len(all_studies)}")
+            studies.extend(current_studies)
+            print(f"[*] {label} page {page_count}: Fetched {len(current_studies)} studies. Total so far: {len(studies)}")
             next_page_token = data.get('nextPageToken')
             if not next_page_token: break
             page_count += 1
-            time.sleep(0.5)
         except requests.exceptions.RequestException as e:
-            print(f"\n[!] API request failed on page {page_count}: {e}")
+            print(f"\n[!] API request failed on {label} page {page_count}: {e}")
             break
+    return studies
+
+def fetch_clinical_trials_data(api_url, keyword, output_filename):
+    """
+    Searches the ClinicalTrials.gov API for studies matching a keyword
+    and saves the raw results as NDJSON (one study per line).
+
+    The API only paginates through opaque page tokens, so the search is split
+    into one query per overall status and those page chains are fetched concurrently.
+    """
+    print(f"[*] Starting API query to fetch clinical trial data for keyword: '{keyword}'...")
+    eligibility_search = f'AREA[EligibilityCriteria]({keyword}) AND SEARCH[Location](AREA[LocationCountry]"{COUNTRY_TO_ISOLATE}")'
+    fields_to_get = ["NCTId", "protocolSection", "resultsSection"]
+    params = {'query.term': eligibility_search, 'fields': ",".join(fields_to_get), 'pageSize': 100}
+
+    total_count = None
+    try:
+        response = API_SESSION.get(api_url, params={'query.term': eligibility_search, 'fields': 'NCTId', 'pageSize': 1, 'countTotal': 'true'}, timeout=API_TIMEOUT)
+        response.raise_for_status()
+        total_count = response.json().get('totalCount')
+        print(f"[*] API reports {total_count} matching studies.")
+    except requests.exceptions.RequestException as e:
+        print(f"\n[!] Could not retrieve total study count: {e}")
+
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as executor:
+        futures = [executor.submit(_fetch_study_pages, api_url, {**params, 'filter.overallStatus': status}, status) for status in STUDY_STATUSES]
+        all_studies = [study for future in futures for study in future.result()]
+
+    if total_count is not None and len(all_studies) != total_count:
+        print(f"[!] Fetched {len(all_studies)} studies but the API reported {total_count}; some pages may be missing.")
 
     if all_studies:
         os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump({'studies': all_studies}, f, ensure_ascii=False, indent=2)
+        with open(output_filename, 'wb') as f:
+            for study in all_studies:
+                f.write(orjson.dumps(study) + b'\n')
         print(f"\n[*] Success! Saved {len(all_studies)} total studies to '{output_filename}'.")
     else:
         print("\n[!] No studies were found to save.")
 
 # --- 2. Data Processing and Feature Extraction ---
 
+def iter_raw_studies(ndjson_filename, json_filename):
+    """
+    Yields raw study records one at a time so the full download is never held in memory.
+    Prefers the NDJSON download and falls back to streaming the legacy {'studies': [...]} JSON file.
+    """
+    if os.path.exists(ndjson_filename):
+        with open(ndjson_filename, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+    else:
+        with open(json_filename, 'rb') as f:
+            yield from ijson.items(f, 'studies.item', use_float=True)
+
+# Patterns and lookup tables shared by every study, compiled once at import time
+_EXCLUSION_RE = re.compile(r'exclusion', re.IGNORECASE)
+_SENTENCE_SPLIT_RE = re.compile(r'[.\n]')
+_NUMERAL_PATTERN = r'\b(vi|v|iv|iii|ii|i|l|[1-6])\b'
+_NUMERAL_RE = re.compile(_NUMERAL_PATTERN, re.IGNORECASE)
+_RANGE_RE = re.compile(rf'{_NUMERAL_PATTERN}\s*(?:-|to|through)\s*{_NUMERAL_PATTERN}', re.IGNORECASE)
+_ROMAN_TO_INT = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6}
+_INT_TO_ROMAN = {v: k for k, v in _ROMAN_TO_INT.items()}
+# Listed numerals are collected into a 6-bit mask (bit 0 = Type I ... bit 5 = Type VI)
+_NUMERAL_BIT = {**{str(v): 1 << (v - 1) for v in _INT_TO_ROMAN}, **{k.lower(): 1 << (v - 1) for k, v in _ROMAN_TO_INT.items()}, 'l': 1}
+_MASK_TO_STR = [", ".join(_INT_TO_ROMAN[i + 1] for i in range(6) if mask >> i & 1) or 'Not Specified' for mask in range(64)]
+
+def _numeral_to_int(s):
+    """Converts a matched numeral (Roman, Arabic, or an 'l' typo for 'I') to an integer."""
+    s_upper = s.upper()
+    if s_upper == 'L': return 1
+    return int(s) if s.isdigit() else _ROMAN_TO_INT.get(s_upper)
+
 def parse_eligibility_criteria(study_record, keyword):
     """Finds sentences mentioning a keyword in the eligibility criteria."""
     eligibility_text = study_record.get('protocolSection', {}).get('eligibilityModule', {}).get('eligibilityCriteria', '')
     if not eligibility_text: return []
-    parts = re.split(r'exclusion', eligibility_text, flags=re.IGNORECASE)
+    parts = _EXCLUSION_RE.split(eligibility_text)
     found_sentences = []
     for text_part, is_exclusion in [(parts[0], False), (parts[1] if len(parts) > 1 else "", True)]:
         if not text_part: continue
-        for sentence in re.split(r'[.\n]', text_part):
+        for sentence in _SENTENCE_SPLIT_RE.split(text_part):
             if keyword in sentence.lower() and sentence.strip():
                 found_sentences.append({'sentence': sentence.strip(), 'is_exclusion': is_exclusion})
     return found_sentences
 
-def extract_and_standardize_scores(sentence):
-    """Analyzes a sentence to extract and format Fitzpatrick scores."""
-    if not isinstance(sentence, str): return {}
-    text = sentence.lower()
-    result = {'extracted_score': 'Not Specified', 'Type_I': 0, 'Type_II': 0, 'Type_III': 0, 'Type_IV': 0, 'Type_V': 0, 'Type_VI': 0}
-    if any(word in text for word in ['wrinkle']):
-        result['extracted_score'] = 'Not a Skin Type Score'
-        return result
+@lru_cache(maxsize=4096)
+def _classify_score_text(text):
+    """Classifies a lowercased sentence into its score label and 6-bit Fitzpatrick type mask."""
+    if 'wrinkle' in text:
+        return 'Not a Skin Type Score', 0
     if 'all' in text or 'any' in text:
-        result.update({k: 1 for k in result if k.startswith('Type_')})
-        result['extracted_score'] = 'All'
-        return result
+        return 'All', 0b111111
 
-    roman_map = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6}
-    to_roman_map = {v: k for k, v in roman_map.items()}
-    
-    def _to_int(s):
-        s_upper = s.upper()
-        if s_upper == 'L': return 1
-        return int(s) if s.isdigit() else roman_map.get(s_upper)
-
-    valid_numeral_pattern = r'\b(vi|v|iv|iii|ii|i|l|[1-6])\b'
-    range_pattern = f'{valid_numeral_pattern}\\s*(?:-|to|through)\\s*{valid_numeral_pattern}'
-    range_match = re.search(range_pattern, text, re.IGNORECASE)
+    range_match = _RANGE_RE.search(text)
 
     if range_match:
         start_str, end_str = range_match.groups()
-        start_num, end_num = _to_int(start_str), _to_int(end_str)
+        start_num, end_num = _numeral_to_int(start_str), _numeral_to_int(end_str)
         if start_num is not None and end_num is not None and start_num < end_num:
-            for i in range(start_num, end_num + 1):
-                if i in to_roman_map: result[f"Type_{to_roman_map[i]}"] = 1
-            result['extracted_score'] = f"{to_roman_map.get(start_num, '')}-{to_roman_map.get(end_num, '')}"
-    else:
-        numerals_found = re.findall(valid_numeral_pattern, text, re.IGNORECASE)
-        scores = sorted(list(set(_to_int(n) for n in numerals_found if _to_int(n) is not None)))
-        roman_scores = []
-        for score in scores:
-            roman_version = to_roman_map.get(score)
-            if roman_version:
-                result[f"Type_{roman_version}"] = 1
-                roman_scores.append(roman_version)
-        if roman_scores: result['extracted_score'] = ", ".join(roman_scores)
+            mask = (1 << end_num) - (1 << (start_num - 1))
+            return f"{_INT_TO_ROMAN.get(start_num, '')}-{_INT_TO_ROMAN.get(end_num, '')}", mask
+        return 'Not Specified', 0
+
+    mask = 0
+    for numeral in _NUMERAL_RE.findall(text):
+        bit = _NUMERAL_BIT.get(numeral)
+        if bit is None: # case-fold matches such as a dotless 'ı' go through the full conversion
+            value = _numeral_to_int(numeral)
+            bit = 1 << (value - 1) if value else 0
+        mask |= bit
+    return _MASK_TO_STR[mask], mask
+
+def extract_and_standardize_scores(sentence):
+    """Analyzes a sentence to extract and format Fitzpatrick scores."""
+    if not isinstance(sentence, str): return {}
+    extracted_score, mask = _classify_score_text(sentence.lower())
+    result = {'extracted_score': extracted_score}
+    for i in range(6):
+        result[f"Type_{_INT_TO_ROMAN[i + 1]}"] = mask >> i & 1
     return result
 
 def extract_study_details(study_record, country):
@@ -162,52 +248,114 @@ def extract_study_details(study_record, country):
     return details
 
 def process_raw_data(studies):
-    """Processes raw JSON data into a clean DataFrame ready for geocoding."""
+    """
+    Processes raw JSON data into a clean DataFrame ready for geocoding.
+
+    A first pass extracts every usable study once and fixes the output schema (row count
+    and race columns); a second pass fills preallocated column arrays by position.
+    """
     print("[*] Processing raw study data...")
-    all_facility_rows, all_race_keys = [], set()
+    skin_type_cols = [f'Type_{r}' for r in ['I', 'II', 'III', 'IV', 'V', 'VI']]
+    kept_studies, race_keys, n_rows, n_studies = [], {}, 0, 0
     for study in studies:
+        n_studies += 1
         nct_id = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', 'N/A')
         details = extract_study_details(study, COUNTRY_TO_ISOLATE)
         if not details['us_facilities']: continue
         
-        all_race_keys.update(details['race_data'].keys())
+        race_keys.update(dict.fromkeys(details['race_data']))
         inclusion_sentences = [s['sentence'] for s in parse_eligibility_criteria(study, SEARCH_KEYWORD) if not s['is_exclusion']]
         if not inclusion_sentences: continue
         
         score_data = extract_and_standardize_scores(inclusion_sentences[0])
         if score_data['extracted_score'] == 'Not a Skin Type Score': continue
-            
-        for facility in details['us_facilities']:
-            row = {'nctId': nct_id, 'status': details['status'], 'enrollment': details['enrollment'], 'enrollment_type': details['enrollment_type'], 'last_update_year': details['last_update_year']}
-            row.update(score_data)
-            row.update(facility)
-            row.update(details['race_data'])
-            all_facility_rows.append(row)
+
+        kept_studies.append((nct_id, details, score_data))
+        n_rows += len(details['us_facilities'])
     
-    if not all_facility_rows:
+    if not n_rows:
         print("[!] No processable US-based facilities found.")
         return pd.DataFrame()
 
-    df = pd.DataFrame(all_facility_rows)
-    for race_col in all_race_keys:
-        if race_col not in df.columns: df[race_col] = 0
-    df.fillna(0, inplace=True)
+    study_cols = ['nctId', 'status', 'enrollment', 'enrollment_type', 'last_update_year', 'extracted_score']
+    facility_cols = ['facility', 'city', 'state', 'zip']
+    columns = {col: np.empty(n_rows, dtype=object) for col in study_cols}
+    columns.update({col: np.zeros(n_rows, dtype=np.int8) for col in skin_type_cols})
+    columns.update({col: np.empty(n_rows, dtype=object) for col in facility_cols})
+    columns.update({col: np.full(n_rows, np.nan) for col in ['latitude', 'longitude']})
+    columns.update({col: np.zeros(n_rows, dtype=np.int32) for col in race_keys})
+
+    start = 0
+    for nct_id, details, score_data in kept_studies:
+        # Study-level values are broadcast across the contiguous block of that study's facilities
+        end = start + len(details['us_facilities'])
+        columns['nctId'][start:end] = nct_id
+        for col in ['status', 'enrollment', 'enrollment_type', 'last_update_year']:
+            columns[col][start:end] = details[col]
+        for col in ['extracted_score'] + skin_type_cols:
+            columns[col][start:end] = score_data[col]
+        for race_col, count in details['race_data'].items():
+            columns[race_col][start:end] = count
+        for i, facility in enumerate(details['us_facilities'], start):
+            for col in facility_cols + ['latitude', 'longitude']:
+                columns[col][i] = facility[col]
+        start = end
+
+    df = pd.DataFrame(columns)
     
-    skin_type_cols = [f'Type_{r}' for r in ['I', 'II', 'III', 'IV', 'V', 'VI']]
     unparsed_mask = df[skin_type_cols].sum(axis=1) == 0
     if not df[~unparsed_mask].empty:
         print(f"[*] Dropping {unparsed_mask.sum()} records with no specific Fitzpatrick scores.")
-        df = df[~unparsed_mask].copy()
+        df = df[~unparsed_mask].reset_index(drop=True)
     
-    print(f"[*] Processed data into {len(df)} facility-level records.")
+    print(f"[*] Processed {n_studies} studies into {len(df)} facility-level records.")
     return df
 
 # --- 3. Google Maps Places API Geocoding ---
 
+def _normalize_key_part(series):
+    """Lowercases and collapses whitespace so trivially different spellings share a lookup."""
+    return series.str.strip().str.lower().str.replace(r'\s+', ' ', regex=True)
+
+def _cache_key(lookup_key):
+    """Hashes a normalized lookup key into the fixed-width key used by the on-disk Places cache."""
+    return hashlib.sha1(lookup_key.encode('utf-8')).hexdigest()
+
+def _load_geocode_cache(conn):
+    """Creates the on-disk Places cache if needed and returns its unexpired entries."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS place_lookups (key_sha1 TEXT PRIMARY KEY, found INTEGER, latitude REAL, longitude REAL, "
+        "place_name TEXT, place_id TEXT, formatted_address TEXT, fetched_at REAL)"
+    )
+    cutoff = time.time() - GEOCODE_CACHE_TTL_DAYS * 24 * 60 * 60
+    rows = conn.execute(
+        "SELECT key_sha1, found, latitude, longitude, place_name, place_id, formatted_address FROM place_lookups WHERE fetched_at >= ?", (cutoff,)
+    )
+    return {key: (bool(found), *fields) for key, found, *fields in rows}
+
+def _lookup_place(gmaps, query):
+    """Runs one Places text search and reduces it to a (found, lat, lng, name, place_id, address) cache entry."""
+    for attempt in range(PLACES_MAX_RETRIES + 1):
+        try:
+            # Use Places API Text Search, requesting specific fields for efficiency
+            result = gmaps.places(query=query)
+            break
+        except (googlemaps.exceptions.ApiError, googlemaps.exceptions.TransportError, googlemaps.exceptions.Timeout) as e:
+            retryable = not isinstance(e, googlemaps.exceptions.ApiError) or e.status == 'OVER_QUERY_LIMIT'
+            if not retryable or attempt == PLACES_MAX_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+    if result and result.get('results'):
+        place = result['results'][0]
+        location = place.get('geometry', {}).get('location', {})
+        return (True, location.get('lat'), location.get('lng'), place.get('name'), place.get('place_id'), place.get('formatted_address'))
+    return (False, None, None, None, None, None)
+
 def geocode_locations_with_places_api(df_to_geocode):
     """
     Enriches a DataFrame with coordinates and place names using Google Places API.
     Only updates rows that can be successfully geocoded.
+    The DataFrame is updated in place and returned.
     """
     load_dotenv()
     API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
@@ -215,114 +363,178 @@ def geocode_locations_with_places_api(df_to_geocode):
         raise ValueError("Google Maps API key not found in .env file.")
     gmaps = googlemaps.Client(key=API_KEY)
     
-    df = df_to_geocode.copy()
+    df = df_to_geocode
     
     print("\n[*] Preparing search queries for Google Places API...")
-    for col in ['facility', 'city', 'state', 'zip']:
-        df[col] = df[col].astype(str)
+    # Arrow-backed strings keep the masking and concatenation below in Arrow compute kernels
+    query_cols = ['facility', 'city', 'state', 'zip']
+    df[query_cols] = df[query_cols].astype('string[pyarrow]').fillna('N/A')
 
-    ends_with_site = df['facility'].str.lower().str.endswith('site', na=False)
-    ends_with_number = df['facility'].str.contains(r'\d+$', regex=True, na=False)
-    
     fatal_flaw = (
         df['facility'].isin(['N/A', 'nan']) |
         df['facility'].str.startswith('Call Suneva', na=False) |
-        df['zip'].isin(['00000']) |
-        ends_with_site |
-        ends_with_number
+        df['zip'].isin(['00000'])
     )
+    # Placeholder names such as "Research Site" or "Site 0123" can't be looked up either; the
+    # regex only runs over the rows that survived the cheap checks above
+    candidates = ~fatal_flaw
+    fatal_flaw[candidates] = df.loc[candidates, 'facility'].str.contains(r'(?i)(?:site|\d+)$', regex=True, na=False)
     bad_zip = df['zip'].isin(['N/A', 'nan'])
     
-    df['search_query'] = 'SKIP'
     workable_rows = ~fatal_flaw
-    
-    # Rows with good zip codes
-    good_zip_rows = workable_rows & ~bad_zip
-    df.loc[good_zip_rows, 'search_query'] = (
-        df.loc[good_zip_rows, 'facility'] + ', ' + df.loc[good_zip_rows, 'city'] + ', ' +
-        df.loc[good_zip_rows, 'state'] + ' ' + df.loc[good_zip_rows, 'zip']
-    )
-    # Rows with missing zip codes but otherwise good info
-    missing_zip_rows = workable_rows & bad_zip
-    df.loc[missing_zip_rows, 'search_query'] = (
-        df.loc[missing_zip_rows, 'facility'] + ', ' + df.loc[missing_zip_rows, 'city'] + ', ' + df.loc[missing_zip_rows, 'state']
-    )
 
-    rows_to_process = df[df['search_query'] != 'SKIP']
-    print(f"[*] Found {len(rows_to_process)} rows to geocode ({len(df) - len(rows_to_process)} rows will be skipped).")
+    # Skipped rows only get the 'SKIP' marker; queries are built for the workable rows alone,
+    # from facility, city and state plus the zip when there is a good one
+    rows_to_process = df.loc[workable_rows, ['facility', 'city', 'state', 'zip', 'latitude', 'longitude']]
+    base_query = rows_to_process['facility'].str.cat([rows_to_process['city'], rows_to_process['state']], sep=', ')
+    zip_query = base_query.str.cat(rows_to_process['zip'], sep=' ')
+    rows_to_process['search_query'] = np.where(bad_zip[workable_rows].to_numpy(), base_query.to_numpy(), zip_query.to_numpy())
+    df['search_query'] = 'SKIP'
+    df.loc[rows_to_process.index, 'search_query'] = rows_to_process['search_query']
+
+    ready_count = int(workable_rows.sum())
+    print(f"[*] Found {ready_count} rows to geocode ({len(df) - ready_count} rows will be skipped).")
+
+    # Each site is looked up once per normalized facility/city/state (hashed for the cache key); the zip
+    # stays out of the key so the same site listed with a missing or mistyped zip reuses the same result
+    query_keys = (
+        _normalize_key_part(rows_to_process['facility']) + '|' +
+        _normalize_key_part(rows_to_process['city']) + '|' +
+        rows_to_process['state'].str.strip().str.upper()
+    ).map(_cache_key)
+    unique_queries = rows_to_process['search_query'].groupby(query_keys, sort=False).first()
+    print(f"[*] {len(unique_queries)} unique sites to look up across those rows.")
     
     df['place_name'] = '' # Add new column for Google's official place name
-    query_cache = {}
-
-    for index, row in tqdm(rows_to_process.iterrows(), total=len(rows_to_process), desc="Geocoding with Places API"):
-        query = row['search_query']
-        if query in query_cache:
-            result = query_cache[query]
-        else:
-            try:
-                # Use Places API Text Search, requesting specific fields for efficiency
-                result = gmaps.places(query=query)
-                query_cache[query] = result
-                time.sleep(0.02)
-            except Exception as e:
-                print(f"\n[!] API Error for query '{query}': {e}")
-                query_cache[query] = None
-                continue
-        
-        if result and result.get('results'):
-            place = result['results'][0]
-            location = place.get('geometry', {}).get('location', {})
-            df.loc[index, 'latitude'] = location.get('lat')
-            df.loc[index, 'longitude'] = location.get('lng')
-            df.loc[index, 'place_name'] = place.get('name')
-        else:
-            df.loc[index, 'place_name'] = 'NO_RESULTS_FOUND'
+
+    # Lookups are cached on disk across runs as (found, lat, lng, name, place_id, address); failed calls are only remembered for this run
+    os.makedirs(os.path.dirname(GEOCODE_CACHE_DB), exist_ok=True)
+    cache_conn = sqlite3.connect(GEOCODE_CACHE_DB)
+    query_cache = _load_geocode_cache(cache_conn)
+    print(f"[*] Loaded {len(query_cache)} cached Places lookups from '{GEOCODE_CACHE_DB}'.")
+
+    # Uncached sites are looked up concurrently (the client throttles itself to its QPS limit);
+    # results are written to the cache as they arrive so an interrupted run keeps its progress
+    pending = {key: query for key, query in unique_queries.items() if key not in query_cache}
+    try:
+        with ThreadPoolExecutor(max_workers=PLACES_MAX_WORKERS) as executor:
+            futures = {executor.submit(_lookup_place, gmaps, query): (key, query) for key, query in pending.items()}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Geocoding with Places API"):
+                key, query = futures[future]
+                try:
+                    cached = future.result()
+                except Exception as e:
+                    print(f"\n[!] API Error for query '{query}': {e}")
+                    query_cache[key] = None
+                    continue
+                query_cache[key] = cached
+                cache_conn.execute("INSERT OR REPLACE INTO place_lookups VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, *cached, time.time()))
+    finally:
+        cache_conn.commit()
+        cache_conn.close()
+
+    # Spread each site's result back over all of its rows; failed calls leave the row untouched
+    results = [query_cache.get(key) for key in query_keys]
+    df.loc[rows_to_process.index, 'latitude'] = [r[1] if r and r[0] else lat for r, lat in zip(results, rows_to_process['latitude'])]
+    df.loc[rows_to_process.index, 'longitude'] = [r[2] if r and r[0] else lon for r, lon in zip(results, rows_to_process['longitude'])]
+    df.loc[rows_to_process.index, 'place_name'] = ['' if r is None else r[3] if r[0] else 'NO_RESULTS_FOUND' for r in results]
             
     return df
 
 # --- 4. Interactive Map Generation ---
 
-def create_interactive_map_with_sidebar(map_data, filename):
-    """Creates an interactive Folium map with a custom sidebar for filtering markers."""
-    if not map_data:
+def _insert_after(page, pattern, text):
+    """Inserts text right after the first match of pattern in the rendered page, failing loudly if it is missing."""
+    match = re.search(pattern, page)
+    if not match:
+        raise ValueError(f"Could not find '{pattern}' in the rendered map page; the folium template may have changed.")
+    return page[:match.end()] + text + page[match.end():]
+
+def _write_gzip_copy(path):
+    """Writes a precompressed copy of a generated file alongside it as '<path>.gz'."""
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb', compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst)
+
+def _to_base64(values, dtype):
+    """Packs numbers into a typed-array buffer of the given numpy dtype and base64-encodes it for the page's JavaScript."""
+    return base64.b64encode(np.asarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+def _to_js_literal(value):
+    """Serializes a Python value to a compact UTF-8 JSON literal for embedding in the page's JavaScript."""
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+def create_interactive_map_with_sidebar(map_df, filename, data_filename):
+    """
+    Creates an interactive Folium map with a custom sidebar for filtering markers.
+    The map's data is written to a companion JSON file that the page fetches when it loads.
+    """
+    if map_df.empty:
         print("[!] No data available to create a map.")
         return
 
-    print(f"[*] Generating interactive map from {len(map_data)} records...")
+    print(f"[*] Generating interactive map from {len(map_df)} records...")
     us_center = [39.8283, -98.5795]
     m = folium.Map(location=us_center, zoom_start=4, tiles="cartodbpositron")
     HeatMap([]).add_to(m)
 
     # --- Prepare data for map layers ---
-    locations_data = defaultdict(list)
-    for rec in map_data:
-        if pd.notna(rec.get('latitude')) and pd.notna(rec.get('longitude')):
-            key = f"{float(rec['latitude']):.6f},{float(rec['longitude']):.6f}"
-            locations_data[key].append(rec)
-
-    heatmap_data = []
-    for loc_key, studies_at_loc in locations_data.items():
-        lat, lon = map(float, loc_key.split(','))
-        count = len(studies_at_loc)
-        weight = math.log1p(count) 
-        heatmap_data.append([lat, lon, weight])
-        
+    # Records sharing coordinates (rounded to 6 decimals) form one location, numbered in first-seen order
+    coords = map_df[['latitude', 'longitude']].astype(float).round(6)
+    has_coords = coords.notna().all(axis=1).to_numpy()
+    grouped = coords[has_coords].groupby(['latitude', 'longitude'], sort=False)
+    record_locations = grouped.ngroup().to_numpy()
+
+    location_sizes = grouped.size()
+    heatmap_data = np.column_stack([
+        location_sizes.index.get_level_values('latitude'),
+        location_sizes.index.get_level_values('longitude'),
+        np.log1p(location_sizes.to_numpy()),
+    ])
+
     heatmap_gradient = {0.4:'blue', 0.6:'lime', 0.8:'yellow', 1.0:'red'}
 
     # --- Prepare data for sidebar filters ---
-    all_race_columns = sorted([col for col in map_data[0].keys() if str(col).startswith('Race_')]) if map_data else []
-    enrollment_values = [r.get('enrollment') for r in map_data if isinstance(r.get('enrollment'), (int, float)) and r.get('enrollment', 0) > 0]
-    max_enrollment = max(enrollment_values) if enrollment_values else 1000
-    year_values = [int(r['last_update_year']) for r in map_data if str(r.get('last_update_year')).isdigit()]
-    min_year, max_year = (min(year_values), max(year_values)) if year_values else (2000, 2025)
-    all_statuses = sorted(set(r.get('status', 'N/A') for r in map_data))
+    all_race_columns = sorted(col for col in map_df.columns if str(col).startswith('Race_'))
+    enrollments = pd.to_numeric(map_df['enrollment'], errors='coerce')
+    positive_enrollments = enrollments[enrollments > 0]
+    max_enrollment = int(positive_enrollments.max()) if not positive_enrollments.empty else 1000
+    years = pd.to_numeric(map_df['last_update_year'], errors='coerce').dropna()
+    min_year, max_year = (int(years.min()), int(years.max())) if not years.empty else (2000, 2025)
+    all_statuses = sorted(map_df['status'].astype(object).fillna('N/A').unique())
     status_display_map = {'ACTIVE_NOT_RECRUITING': 'Active, not recruiting', 'COMPLETED': 'Completed', 'ENROLLING_BY_INVITATION': 'Enrolling by invitation', 'NOT_YET_RECRUITING': 'Not yet recruiting', 'RECRUITING': 'Recruiting', 'SUSPENDED': 'Suspended', 'TERMINATED': 'Terminated', 'WITHDRAWN': 'Withdrawn', 'AVAILABLE': 'Available', 'NO_LONGER_AVAILABLE': 'No longer available', 'TEMPORARILY_NOT_AVAILABLE': 'Temporarily not available', 'APPROVED_FOR_MARKETING': 'Approved for marketing', 'WITHHELD': 'Withheld', 'UNKNOWN': 'Unknown status', 'N/A': 'N/A' }
-    total_studies = len(set(rec.get('nctId') for rec in map_data))
-    total_locations = len(locations_data)
-    race_data = {}
-    for col in all_race_columns:
-        values = [r.get(col, 0) for r in map_data if isinstance(r.get(col), (int, float)) and r.get(col, 0) > 0]
-        if values: race_data[col] = {'min': 0, 'max': int(max(values)), 'display_name': str(col).replace('Race_', '').replace('_', ' ')}
+    total_studies = map_df['nctId'].nunique()
+    total_locations = len(location_sizes)
+    race_counts_df = map_df[all_race_columns].apply(pd.to_numeric, errors='coerce')
+    race_max = race_counts_df.where(race_counts_df > 0).max().dropna()
+    race_data = {col: {'min': 0, 'max': int(max_count), 'display_name': str(col).replace('Race_', '').replace('_', ' ')} for col, max_count in race_max.items()}
+
+    # --- Compact the JS payload ---
+    # Records are laid out column by column: every field ships as its own base64 typed array
+    # (skin types as a 6-bit mask, race counts column by column) with a parallel record -> location
+    # index, coordinates and heatmap points are float32 buffers, and repeated strings become
+    # indexes into lookup tables, so the page never builds per-record objects
+    string_tables = {}
+    def _table_ids(field, values, missing='N/A'):
+        codes, uniques = pd.factorize(values.astype(object).where(values.notna(), missing).map(str))
+        string_tables[field] = list(uniques)
+        return codes.tolist()
+    skin_type_keys = [f'Type_{r}' for r in ['I', 'II', 'III', 'IV', 'V', 'VI']]
+    located_df = map_df[has_coords]
+    record_statuses = _table_ids('status', located_df['status'])
+    enrollment_types = located_df['enrollment_type'].astype(object)
+    enrollment_types = enrollment_types.where(enrollment_types.ne(''), None).map(lambda value: str(value).upper(), na_action='ignore')
+    record_enrollment_types = _table_ids('enrollment_type', enrollment_types)
+    record_nct_ids = _table_ids('nct_id', located_df['nctId'])
+    record_facilities = _table_ids('facility', located_df['facility'])
+    record_cities = _table_ids('city', located_df['city'])
+    record_place_names = _table_ids('place_name', located_df['place_name'], missing='')
+
+    record_type_masks = (located_df[skin_type_keys].to_numpy(dtype=np.uint8) << np.arange(6, dtype=np.uint8)).sum(axis=1)
+    record_years = pd.to_numeric(located_df['last_update_year'], errors='coerce').fillna(0) # 0 = unknown, never filtered out
+    enrollments = pd.to_numeric(located_df['enrollment'], errors='coerce')
+    record_enrollments = enrollments.fillna(0)
+    record_enrollment_known = enrollments.notna() # 0 is only a placeholder: the filter skips the minimum for unknown enrollments, and the popup shows 'N/A'
+    race_counts = located_df[all_race_columns].fillna(0).to_numpy().T # one row per race column
 
     # --- HTML and Sidebar ---
     css_rules = """ body { margin:0; padding:0; font-family:'Segoe UI',sans-serif; } .sidebar { position:fixed; top:0; left:0; width:320px; height:100vh; background:linear-gradient(135deg,#667eea 0%,#764ba2 100%); color:white; padding:20px; box-sizing:border-box; z-index:1001; overflow-y:auto; box-shadow:2px 0 10px rgba(0,0,0,0.2); } .sidebar h2 { margin:0 0 20px 0; font-size:24px; font-weight:300; border-bottom:2px solid rgba(255,255,255,0.3); padding-bottom:10px; } .filter-section { margin-bottom:20px; background:rgba(255,255,255,0.1); padding:15px; border-radius:8px; } .skin-type-item { display:flex; align-items:center; margin:8px 0; padding:8px; border-radius:6px; transition:background 0.3s; cursor:pointer; user-select:none; background:rgba(0,0,0,0.2); } .skin-type-item.active { background:rgba(255,255,255,0.3); } .color-indicator { width:18px; height:18px; border-radius:50%; margin-right:12px; border:2px solid white; } .slider { width:100%; -webkit-appearance:none; appearance:none; height:6px; border-radius:3px; background:rgba(255,255,255,0.3); outline:none; } .slider::-webkit-slider-thumb { -webkit-appearance:none; appearance:none; width:18px; height:18px; border-radius:50%; background:#ffd700; cursor:pointer; } .slider-value { font-size:12px; color:#ffd700; text-align:center; margin-top:5px; font-weight:bold; } .reset-btn { width:100%; padding:10px; background:rgba(255,255,255,0.2); color:white; border:none; border-radius:6px; cursor:pointer; font-size:14px; margin-top:10px; } .checkbox-group, .radio-group { display:flex; flex-direction:column; gap:8px; margin-top:10px; } .checkbox-item, .radio-item { display:flex; align-items:center; cursor:pointer; padding:6px 8px; border-radius:4px; background:rgba(0,0,0,0.2); transition:background 0.2s; } .checkbox-item:hover, .radio-item:hover { background:rgba(255,255,255,0.1); } .checkbox-item input, .radio-item input { margin-right:8px; cursor:pointer; } .checkbox-item label, .radio-item label { cursor:pointer; font-size:13px; flex:1; } .folium-map { position:absolute; top:0; left:320px; right:0; bottom:0; z-index:1000; } .filter-summary { background:rgba(0,0,0,0.2); padding:10px; border-radius:6px; margin-bottom:15px; font-size:13px; } .filter-summary div:not(:last-child) { margin-bottom:4px; } .race-filter { margin-bottom:10px; } .race-filter label { display:block; margin-bottom:5px; font-size:13px; } """
@@ -333,59 +545,102 @@ def create_interactive_map_with_sidebar(map_data, filename):
     viz_switcher_html = """<div class="filter-section"><h3>Visualization Type</h3><div class="radio-group"><div class="radio-item"><input type="radio" id="viz-dots" name="viz-type" value="dots" checked onchange="updateVisualization()"><label for="viz-dots">Individual Locations (Dots)</label></div><div class="radio-item"><input type="radio" id="viz-heatmap" name="viz-type" value="heatmap" onchange="updateVisualization()"><label for="viz-heatmap">Density (Heatmap)</label></div></div></div>"""
     sidebar_html = f""" <div class="sidebar"> <h2>US Fitzpatrick Trials</h2> <div class="filter-summary"> <div><strong>Studies:</strong> <span id="visible-studies-count">{total_studies}</span> of {total_studies}</div> <div><strong>Locations:</strong> <span id="visible-locations-count">{total_locations}</span> of {total_locations}</div> </div> {viz_switcher_html} <div class="filter-section"><h3>Fitzpatrick Skin Types</h3>{skin_type_html}</div> <div class="filter-section"> <h3>Enrollment</h3> <div class="control-group"><label for="min-enrollment">Minimum Enrollment:</label><input type="range" id="min-enrollment" class="slider" min="0" max="{max_enrollment}" value="0" oninput="updateFilters()"><div class="slider-value" id="min-enrollment-value">0+</div></div> <div class="control-group" style="margin-top:15px;"><label style="display:block;margin-bottom:8px;">Enrollment Type:</label><div class="checkbox-group"><div class="checkbox-item"><input type="checkbox" id="enrollment-actual" checked onchange="updateFilters()"><label for="enrollment-actual">Actual</label></div><div class="checkbox-item"><input type="checkbox" id="enrollment-estimated" checked onchange="updateFilters()"><label for="enrollment-estimated">Estimated</label></div><div class="checkbox-item"><input type="checkbox" id="enrollment-na" checked onchange="updateFilters()"><label for="enrollment-na">N/A</label></div></div></div> </div> <div class="filter-section"><h3>Study Status</h3><div class="checkbox-group">{status_checkboxes}</div></div> <div class="filter-section"> <h3>Last Updated Year</h3> <div class="control-group"><label for="year-range">Minimum Year:</label><input type="range" id="year-range" class="slider" min="{min_year}" max="{max_year}" value="{min_year}" oninput="updateFilters()"><div class="slider-value" id="year-range-value">{min_year}+</div></div> </div> <div class="filter-section"><h3>Race Demographics</h3>{race_filter_html}</div> <div class="filter-section"><button class="reset-btn" onclick="resetAllFilters()">Reset All Filters</button></div> </div> """
 
-    # --- UPDATED JavaScript ---
-    javascript_code = """
-        let mapInstance, markersLayer, heatmapLayer;
-        const locationsData = {locations_data_json};
-        const heatmapData = {heatmap_data_json};
-        const heatmapGradient = {heatmap_gradient_json};
-        const allRaceColumns = {all_race_columns_json};
-        const raceDataInfo = {race_data_info_json};
-        const allStatuses = {all_statuses_json};
-        const statusDisplayMap = {status_display_map_json};
-        const minYear = {min_year};
-
-        function findMapInstance() {{ return window[document.querySelector('.folium-map').id]; }}
-        window.addEventListener('load', function() {{ setTimeout(initializeMap, 500); }});
-
-        function initializeMap() {{
+    # --- JavaScript ---
+    # Data constants are serialized once into the companion data file
+    js_constants = {
+        'recordNctIdsB64': _to_base64(record_nct_ids, '<i4'),
+        'recordFacilitiesB64': _to_base64(record_facilities, '<i4'),
+        'recordCitiesB64': _to_base64(record_cities, '<i4'),
+        'recordPlaceNamesB64': _to_base64(record_place_names, '<i4'),
+        'recordStatusesB64': _to_base64(record_statuses, '<u1'),
+        'recordEnrollmentTypesB64': _to_base64(record_enrollment_types, '<u1'),
+        'recordTypeMasksB64': _to_base64(record_type_masks, '<u1'),
+        'recordYearsB64': _to_base64(record_years, '<u2'),
+        'recordEnrollmentsB64': _to_base64(record_enrollments, '<i4'),
+        'recordEnrollmentKnownB64': _to_base64(record_enrollment_known, '<u1'),
+        'raceCountsB64': _to_base64(race_counts, '<i4'),
+        'recordLocationsB64': _to_base64(record_locations, '<i4'),
+        'locationLatsB64': _to_base64(heatmap_data[:, 0], '<f4'),
+        'locationLonsB64': _to_base64(heatmap_data[:, 1], '<f4'),
+        'heatmapB64': _to_base64(heatmap_data, '<f4'),
+        'heatmapGradient': heatmap_gradient,
+        'allRaceColumns': all_race_columns,
+        'raceDataInfo': race_data,
+        'allStatuses': all_statuses,
+        'statusDisplayMap': status_display_map,
+        'nctIdTable': list(string_tables['nct_id']),
+        'statusTable': list(string_tables['status']),
+        'enrollmentTypeTable': list(string_tables['enrollment_type']),
+        'facilityTable': list(string_tables['facility']),
+        'cityTable': list(string_tables['city']),
+        'placeNameTable': list(string_tables['place_name']),
+        'minYear': min_year,
+    }
+    javascript_logic = """
+        function decodeBase64(b64, ArrayType) {
+            const bin = atob(b64);
+            const bytes = new Uint8Array(bin.length);
+            for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+            return new ArrayType(bytes.buffer);
+        }
+        const skinTypes = ['I', 'II', 'III', 'IV', 'V', 'VI'];
+        let recordLocations, locationLats, locationLons, heatmapData;
+        let recordNctIds, recordFacilities, recordCities, recordPlaceNames;
+        let recordStatuses, recordEnrollmentTypes, recordTypeMasks, recordYears, recordEnrollments, recordEnrollmentKnown, raceCounts;
+        function decodeMapData(data) {
+            assignMapData(data);
+            recordLocations = decodeBase64(recordLocationsB64, Int32Array);
+            recordNctIds = decodeBase64(recordNctIdsB64, Int32Array);
+            recordFacilities = decodeBase64(recordFacilitiesB64, Int32Array);
+            recordCities = decodeBase64(recordCitiesB64, Int32Array);
+            recordPlaceNames = decodeBase64(recordPlaceNamesB64, Int32Array);
+            recordStatuses = decodeBase64(recordStatusesB64, Uint8Array);
+            recordEnrollmentTypes = decodeBase64(recordEnrollmentTypesB64, Uint8Array);
+            recordTypeMasks = decodeBase64(recordTypeMasksB64, Uint8Array);
+            recordYears = decodeBase64(recordYearsB64, Uint16Array);
+            recordEnrollments = decodeBase64(recordEnrollmentsB64, Int32Array);
+            recordEnrollmentKnown = decodeBase64(recordEnrollmentKnownB64, Uint8Array);
+            raceCounts = decodeBase64(raceCountsB64, Int32Array);
+            locationLats = decodeBase64(locationLatsB64, Float32Array);
+            locationLons = decodeBase64(locationLonsB64, Float32Array);
+            const heatmapValues = decodeBase64(heatmapB64, Float32Array);
+            heatmapData = [];
+            for (let i = 0; i < heatmapValues.length; i += 3) heatmapData.push([heatmapValues[i], heatmapValues[i + 1], heatmapValues[i + 2]]);
+        }
+
+        function findMapInstance() { return window[document.querySelector('.folium-map').id]; }
+        window.addEventListener('load', function() { setTimeout(initializeMap, 500); });
+
+        function initializeMap() {
             mapInstance = findMapInstance();
-            if (!mapInstance) {{ console.error("Map instance not found."); return; }}
-            markersLayer = L.layerGroup();
-            heatmapLayer = L.heatLayer(heatmapData, {{ radius: 25, blur: 15, gradient: heatmapGradient }});
-            updateVisualization();
-            updateFilters();
-        }}
+            if (!mapInstance) { console.error("Map instance not found."); return; }
+            fetch(mapDataUrl)
+                .then(response => response.json())
+                .then(data => {
+                    decodeMapData(data);
+                    markersLayer = L.layerGroup();
+                    heatmapLayer = L.heatLayer(heatmapData, { radius: 25, blur: 15, gradient: heatmapGradient });
+                    updateVisualization();
+                    updateFilters();
+                })
+                .catch(error => console.error("Could not load map data.", error));
+        }
         
-        window.updateVisualization = function() {{
+        window.updateVisualization = function() {
             const vizType = document.querySelector('input[name="viz-type"]:checked').value;
-            if (vizType === 'dots') {{
+            if (vizType === 'dots') {
                 if (mapInstance.hasLayer(heatmapLayer)) mapInstance.removeLayer(heatmapLayer);
                 if (!mapInstance.hasLayer(markersLayer)) mapInstance.addLayer(markersLayer);
-            }} else {{ // heatmap
+            } else { // heatmap
                 if (mapInstance.hasLayer(markersLayer)) mapInstance.removeLayer(markersLayer);
                 if (!mapInstance.hasLayer(heatmapLayer)) mapInstance.addLayer(heatmapLayer);
-            }}
-        }};
-
-        function passesFilters(record, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypes, yearFilter) {{
-            if (!activeTypes.some(type => record[`Type_${{type}}`] === 1)) return false;
-            const recordYear = parseInt(record.last_update_year);
-            if (!isNaN(recordYear) && recordYear < yearFilter) return false;
-            const enrollment = record.enrollment === 'N/A' ? 0 : record.enrollment;
-            if (enrollment < enrollmentFilter) return false;
-            if (!enrollmentTypes.includes((record.enrollment_type || 'N/A').toUpperCase())) return false;
-            if (!statusTypes.includes(record.status || 'N/A')) return false;
-            for (const [raceCol, minVal] of Object.entries(raceFilters)) {{
-                if ((record[raceCol] || 0) < minVal) return false;
-            }}
-            return true;
-        }}
+            }
+        };
 
         // ==========================================================
         // ===== THIS ENTIRE FUNCTION HAS BEEN UPDATED =============
         // ==========================================================
-        window.updateFilters = function() {{
+        window.updateFilters = function() {
             if (!mapInstance || !markersLayer) return;
 
             // 1. Get all current filter values from the sidebar
@@ -398,17 +653,17 @@ def create_interactive_map_with_sidebar(map_data, filename):
             if (document.getElementById('enrollment-actual').checked) enrollmentTypes.push('ACTUAL');
             if (document.getElementById('enrollment-estimated').checked) enrollmentTypes.push('ESTIMATED');
             if (document.getElementById('enrollment-na').checked) enrollmentTypes.push('N/A');
-            const statusTypes = allStatuses.filter(status => document.getElementById(`status-${{status.toLowerCase()}}`)?.checked);
-            const raceFilters = {{}};
-            for (const raceCol in raceDataInfo) {{
+            const statusTypes = allStatuses.filter(status => document.getElementById(`status-${status.toLowerCase()}`)?.checked);
+            const raceFilters = {};
+            for (const raceCol in raceDataInfo) {
                 const elId = raceCol.toLowerCase();
                 const element = document.getElementById(elId);
-                if (element) {{
+                if (element) {
                     const minValue = parseInt(element.value);
                     raceFilters[raceCol] = minValue;
                     document.getElementById(elId + '-value').textContent = minValue + '+';
-                }}
-            }}
+                }
+            }
 
             // 2. Prepare for rebuilding layers
             markersLayer.clearLayers();
@@ -416,55 +671,76 @@ def create_interactive_map_with_sidebar(map_data, filename):
             const visibleStudies = new Set();
             const newHeatmapData = []; // <-- Key change: Create new array for filtered heatmap data
 
-            // 3. Loop through all locations and apply filters once
-            for (const [locKey, studiesAtLoc] of Object.entries(locationsData)) {{
-                const passingStudies = studiesAtLoc.filter(study => passesFilters(study, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypes, yearFilter));
+            // 3. Turn each filter into a lookup table or bitmask, scan the typed arrays once
+            //    and group the indexes of passing records by location
+            const activeTypeMask = activeTypes.reduce((mask, type) => mask | (1 << skinTypes.indexOf(type)), 0);
+            const allowedStatuses = Uint8Array.from(statusTable, status => statusTypes.includes(status));
+            const allowedEnrollmentTypes = Uint8Array.from(enrollmentTypeTable, type => enrollmentTypes.includes(type));
+            const raceMinimums = Object.entries(raceFilters).filter(([, minVal]) => minVal > 0).map(([raceCol, minVal]) => [allRaceColumns.indexOf(raceCol), minVal]);
+            const numRecords = recordLocations.length;
+            const passingByLocation = [];
+            for (let i = 0; i < numRecords; i++) {
+                if (!(recordTypeMasks[i] & activeTypeMask)) continue;
+                if (recordYears[i] !== 0 && recordYears[i] < yearFilter) continue;
+                if (recordEnrollmentKnown[i] && recordEnrollments[i] < enrollmentFilter) continue; // unknown enrollments are not held to the minimum
+                if (!allowedEnrollmentTypes[recordEnrollmentTypes[i]] || !allowedStatuses[recordStatuses[i]]) continue;
+                if (raceMinimums.some(([raceIdx, minVal]) => raceCounts[raceIdx * numRecords + i] < minVal)) continue;
+                const loc = recordLocations[i];
+                (passingByLocation[loc] = passingByLocation[loc] || []).push(i);
+            }
+            for (let loc = 0; loc < passingByLocation.length; loc++) {
+                const passingStudies = passingByLocation[loc];
                 
-                if (passingStudies.length > 0) {{
+                if (passingStudies) {
                     visibleLocations++;
-                    passingStudies.forEach(study => visibleStudies.add(study.nctId));
-                    const [lat, lon] = locKey.split(',').map(Number);
+                    passingStudies.forEach(recordIdx => visibleStudies.add(recordNctIds[recordIdx]));
+                    const lat = locationLats[loc], lon = locationLons[loc];
                     
                     // --- A. Rebuild the MARKERS as before ---
                     let popupHtml = '<div style="font-family: Arial, sans-serif; max-height: 300px; overflow-y: auto; min-width: 350px;">';
-                    passingStudies.forEach((study, i) => {{
+                    passingStudies.forEach((recordIdx, i) => {
+                        const nctId = nctIdTable[recordNctIds[recordIdx]];
                         let raceHtml = "";
-                        allRaceColumns.forEach(raceCol => {{
-                            const count = study[raceCol] || 0;
-                            if (count > 0) raceHtml += `<li>${{raceDataInfo[raceCol]?.display_name || raceCol}}: <strong>${{count}}</strong></li>`;
-                        }});
-                        if (raceHtml) raceHtml = `<p style="margin:5px 0 3px;"><strong>Demographics:</strong></p><ul style="margin:0;padding-left:20px;">${{raceHtml}}</ul>`;
-                        const enrollmentDisplay = study.enrollment !== 'N/A' && study.enrollment_type !== 'N/A' ? `${{study.enrollment}} (${{study.enrollment_type}})` : (study.enrollment || 'N/A');
-                        const statusDisplay = statusDisplayMap[study.status] || study.status;
-                        const includedSkinTypes = ['I', 'II', 'III', 'IV', 'V', 'VI'].filter(roman => study[`Type_${{roman}}`] === 1);
+                        allRaceColumns.forEach((raceCol, raceIdx) => {
+                            const count = raceCounts[raceIdx * numRecords + recordIdx];
+                            if (count > 0) raceHtml += `<li>${raceDataInfo[raceCol]?.display_name || raceCol}: <strong>${count}</strong></li>`;
+                        });
+                        if (raceHtml) raceHtml = `<p style="margin:5px 0 3px;"><strong>Demographics:</strong></p><ul style="margin:0;padding-left:20px;">${raceHtml}</ul>`;
+                        const enrollment = recordEnrollmentKnown[recordIdx] ? recordEnrollments[recordIdx] : 'N/A';
+                        const enrollmentType = enrollmentTypeTable[recordEnrollmentTypes[recordIdx]];
+                        const enrollmentDisplay = enrollment !== 'N/A' && enrollmentType !== 'N/A' ? `${enrollment} (${enrollmentType})` : (enrollment || 'N/A');
+                        const status = statusTable[recordStatuses[recordIdx]];
+                        const statusDisplay = statusDisplayMap[status] || status;
+                        const includedSkinTypes = skinTypes.filter((roman, bit) => recordTypeMasks[recordIdx] >> bit & 1);
                         const skinTypeDisplay = includedSkinTypes.length > 0 ? includedSkinTypes.join(', ') : 'Not Specified';
-                        const lastUpdateYearDisplay = study.last_update_year || 'N/A';
-                        popupHtml += `<div style="border-top: ${{i > 0 ? '1px solid #ccc' : 'none'}}; padding: 10px 5px;"><h4 style="margin:0 0 10px 0;">Study Details</h4><p><strong>NCT ID:</strong> <a href="https://clinicaltrials.gov/study/${{study.nctId}}" target="_blank">${{study.nctId}}</a></p><p><strong>Status:</strong> ${{statusDisplay}}</p><p><strong>Last Updated:</strong> ${{lastUpdateYearDisplay}}</p><p><strong>Enrollment:</strong> <strong>${{enrollmentDisplay}}</strong></p><p><strong>Facility:</strong> ${{study.facility}}</p><p><strong>Skin Types:</strong> ${{skinTypeDisplay}}</p>${{raceHtml}}</div>`;
-                    }});
+                        const lastUpdateYearDisplay = recordYears[recordIdx] || 'N/A';
+                        popupHtml += `<div style="border-top: ${i > 0 ? '1px solid #ccc' : 'none'}; padding: 10px 5px;"><h4 style="margin:0 0 10px 0;">Study Details</h4><p><strong>NCT ID:</strong> <a href="https://clinicaltrials.gov/study/${nctId}" target="_blank">${nctId}</a></p><p><strong>Status:</strong> ${statusDisplay}</p><p><strong>Last Updated:</strong> ${lastUpdateYearDisplay}</p><p><strong>Enrollment:</strong> <strong>${enrollmentDisplay}</strong></p><p><strong>Facility:</strong> ${facilityTable[recordFacilities[recordIdx]]}</p><p><strong>Skin Types:</strong> ${skinTypeDisplay}</p>${raceHtml}</div>`;
+                    });
                     popupHtml += '</div>';
-                    const firstStudy = passingStudies[0];
-                    const isPrecise = firstStudy.place_name && firstStudy.place_name !== 'NO_RESULTS_FOUND';
+                    const firstRecord = passingStudies[0];
+                    const placeName = placeNameTable[recordPlaceNames[firstRecord]];
+                    const isPrecise = placeName && placeName !== 'NO_RESULTS_FOUND';
                     const tooltipPrefix = isPrecise ? '[Facility]' : '[City]';
-                    const tooltipName = isPrecise ? firstStudy.place_name : firstStudy.city;
-                    L.circleMarker([lat, lon], {{ radius: 6 + Math.sqrt(passingStudies.length), color: '#ffffff', weight: 2, fillColor: '#764ba2', fillOpacity: 0.8 }})
-                        .bindPopup(popupHtml, {{maxWidth: 400}})
-                        .bindTooltip(`${{tooltipPrefix}} ${{tooltipName}} (${{passingStudies.length}} studies)`)
+                    const tooltipName = isPrecise ? placeName : cityTable[recordCities[firstRecord]];
+                    L.circleMarker([lat, lon], { radius: 6 + Math.sqrt(passingStudies.length), color: '#ffffff', weight: 2, fillColor: '#764ba2', fillOpacity: 0.8 })
+                        .bindPopup(popupHtml, {maxWidth: 400})
+                        .bindTooltip(`${tooltipPrefix} ${tooltipName} (${passingStudies.length} studies)`)
                         .addTo(markersLayer);
 
                     // --- B. Add a point to our NEW HEATMAP data ---
                     const count = passingStudies.length;
                     const weight = Math.log1p(count); // Using the same log scaling
                     newHeatmapData.push([lat, lon, weight]);
-                }}
-            }}
+                }
+            }
             
             // 4. Update the UI counts and the heatmap layer
             document.getElementById('visible-locations-count').textContent = visibleLocations;
             document.getElementById('visible-studies-count').textContent = visibleStudies.size;
             heatmapLayer.setLatLngs(newHeatmapData); // <-- Key change: Update the heatmap layer
-        }};
+        };
 
-        window.resetAllFilters = function() {{
+        window.resetAllFilters = function() {
             document.getElementById('viz-dots').checked = true;
             updateVisualization();
             document.querySelectorAll('.skin-type-item').forEach(item => item.classList.add('active'));
@@ -474,63 +750,99 @@ def create_interactive_map_with_sidebar(map_data, filename):
             document.getElementById('enrollment-actual').checked = true;
             document.getElementById('enrollment-estimated').checked = true;
             document.getElementById('enrollment-na').checked = true;
-            allStatuses.forEach(status => {{ const checkbox = document.getElementById(`status-${{status.toLowerCase()}}`); if (checkbox) checkbox.checked = true; }});
+            allStatuses.forEach(status => { const checkbox = document.getElementById(`status-${status.toLowerCase()}`); if (checkbox) checkbox.checked = true; });
             updateFilters();
-        }};
-    """.format(
-        locations_data_json=json.dumps(locations_data),
-        heatmap_data_json=json.dumps(heatmap_data),
-        heatmap_gradient_json=json.dumps(heatmap_gradient),
-        all_race_columns_json=json.dumps(all_race_columns),
-        race_data_info_json=json.dumps(race_data),
-        all_statuses_json=json.dumps(all_statuses),
-        status_display_map_json=json.dumps(status_display_map),
-        min_year=min_year
-    )
-
-    m.get_root().header.add_child(Element(f"<style>{css_rules}</style>"))
-    m.get_root().html.add_child(Element(sidebar_html))
-    m.get_root().script.add_child(Element(javascript_code))
-
-    m.save(filename)
+        };
+"""
+
+    # The data constants are streamed into the companion file as one JSON object; the page
+    # declares them up front and fills them in once the file has been fetched
+    with open(data_filename, 'wb') as fh:
+        for i, (name, value) in enumerate(js_constants.items()):
+            fh.write(b'{' if i == 0 else b',')
+            fh.write(_to_js_literal(name) + b':')
+            fh.write(_to_js_literal(value))
+        fh.write(b'}')
+
+    data_names = ", ".join(js_constants)
+    data_url = os.path.relpath(data_filename, os.path.dirname(os.path.abspath(filename))).replace(os.sep, '/')
+    javascript_code = (
+        "\n        let mapInstance, markersLayer, heatmapLayer;\n"
+        f"        let {data_names};\n"
+        f"        const mapDataUrl = {_to_js_literal(data_url).decode('utf-8')};\n"
+        f"        function assignMapData(data) {{ ({{ {data_names} }} = data); }}\n"
+    ) + javascript_logic
+
+    # Folium only renders the base map page; the styles, sidebar and script are spliced into it as plain strings
+    page = m.get_root().render()
+    page = _insert_after(page, r'<head>', f'\n    <style>{css_rules}</style>')
+    page = _insert_after(page, r'<body>', f'\n    {sidebar_html}')
+    page = _insert_after(page, r'</body>\s*<script>', javascript_code)
+    with open(filename, 'w', encoding='utf-8') as fh:
+        fh.write(page)
     print(f"\n[*] Success! Interactive map saved to '{filename}'.")
+    if WRITE_GZIP_COPIES:
+        for path in (filename, data_filename):
+            _write_gzip_copy(path)
+        print(f"[*] Wrote gzip copies '{filename}.gz' and '{data_filename}.gz'.")
 # --- 5. Main Orchestrator ---
 
+def apply_master_dtypes(df):
+    """Casts the master dataset to compact, typed columns for Parquet storage."""
+    df = df.copy()
+    skin_type_cols = [col for col in df.columns if str(col).startswith('Type_')]
+    race_cols = [col for col in df.columns if str(col).startswith('Race_')]
+    df[skin_type_cols] = df[skin_type_cols].astype('int8')
+    df[race_cols] = df[race_cols].fillna(0).astype('int32')
+    df['enrollment'] = pd.to_numeric(df['enrollment'], errors='coerce').astype('Int32')
+    df['last_update_year'] = pd.to_numeric(df['last_update_year'], errors='coerce').astype('Int16')
+    df[['status', 'facility']] = df[['status', 'facility']].astype('category')
+    return df
+
 def main():
     """Main function to run the entire data processing and mapping pipeline."""
-    if os.path.exists(FINAL_MASTER_CSV):
-        print(f"[*] Final dataset '{FINAL_MASTER_CSV}' found. Skipping to map generation.")
-        df_final = pd.read_csv(FINAL_MASTER_CSV)
+    if os.path.exists(FINAL_MASTER_PARQUET):
+        print(f"[*] Final dataset '{FINAL_MASTER_PARQUET}' found. Skipping to map generation.")
+        df_final = pd.read_parquet(FINAL_MASTER_PARQUET, engine='pyarrow')
+    elif os.path.exists(FINAL_MASTER_CSV):
+        print(f"[*] Legacy final dataset '{FINAL_MASTER_CSV}' found. Skipping to map generation.")
+        df_final = apply_master_dtypes(pd.read_csv(FINAL_MASTER_CSV))
+        # Convert it once so later runs load the typed Parquet copy instead of re-parsing the CSV
+        try:
+            df_final.to_parquet(FINAL_MASTER_PARQUET, engine='pyarrow', compression='zstd', index=False)
+            print(f"[*] Converted it to '{FINAL_MASTER_PARQUET}' for faster loading on later runs.")
+        except IOError as e:
+            print(f"[!] Could not write '{FINAL_MASTER_PARQUET}': {e}")
     else:
         print(f"[!] Final dataset not found. Starting full data pipeline...")
-        # Step 1: Fetch from API if raw JSON doesn't exist
-        if not os.path.exists(RAW_JSON_FILENAME):
-            fetch_clinical_trials_data(API_BASE_URL, SEARCH_KEYWORD, RAW_JSON_FILENAME)
+        # Step 1: Fetch from API if no raw download exists
+        if not os.path.exists(RAW_NDJSON_FILENAME) and not os.path.exists(RAW_JSON_FILENAME):
+            fetch_clinical_trials_data(API_BASE_URL, SEARCH_KEYWORD, RAW_NDJSON_FILENAME)
         
-        # Step 2: Load and process the raw JSON data
+        # Step 2: Stream the raw studies straight into processing
         try:
-            with open(RAW_JSON_FILENAME, 'r', encoding='utf-8') as f:
-                studies = json.load(f).get('studies', [])
-            print(f"[*] Loaded {len(studies)} studies from '{RAW_JSON_FILENAME}'.")
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"[!] Error loading raw JSON file: {e}. Exiting.")
+            df_processed = process_raw_data(iter_raw_studies(RAW_NDJSON_FILENAME, RAW_JSON_FILENAME))
+        except (FileNotFoundError, json.JSONDecodeError, ijson.JSONError) as e:
+            print(f"[!] Error loading raw study data: {e}. Exiting.")
             return
 
-        df_processed = process_raw_data(studies)
         if df_processed.empty:
             print("[!] No data to process after initial parsing. Exiting.")
             return
             
         # Step 3: Geocode locations using Google Places API
-        df_final = geocode_locations_with_places_api(df_processed)
+        df_final = apply_master_dtypes(geocode_locations_with_places_api(df_processed))
         
         # Step 4: Save the final master dataset
         try:
-            os.makedirs(os.path.dirname(FINAL_MASTER_CSV), exist_ok=True)
-            df_final.to_csv(FINAL_MASTER_CSV, index=False, encoding='utf-8')
-            print(f"\n[*] Success! Final master dataset saved to '{FINAL_MASTER_CSV}'.")
+            os.makedirs(os.path.dirname(FINAL_MASTER_PARQUET), exist_ok=True)
+            df_final.to_parquet(FINAL_MASTER_PARQUET, engine='pyarrow', compression='zstd', index=False)
+            print(f"\n[*] Success! Final master dataset saved to '{FINAL_MASTER_PARQUET}'.")
+            if EXPORT_MASTER_CSV:
+                pacsv.write_csv(pa.Table.from_pandas(df_final, preserve_index=False), FINAL_MASTER_CSV)
+                print(f"[*] Exported a CSV copy to '{FINAL_MASTER_CSV}'.")
         except IOError as e:
-            print(f"[!] Error writing final CSV file: {e}")
+            print(f"[!] Error writing final dataset: {e}")
             return
     
     # Final Step: Create the interactive map
@@ -538,10 +850,12 @@ def main():
         print("[!] Final dataset is empty. Cannot create map.")
         return
         
-    # Convert DataFrame to list of dicts for the map function
     # The map's JS expects camelCase keys, so we ensure columns match that format
-    map_data = df_final.to_dict('records')
-    create_interactive_map_with_sidebar(map_data, MAP_OUTPUT_HTML)
+    # and 'N/A' (rather than a null) for a missing enrollment, enrollment type or update year
+    na_cols = ['enrollment', 'enrollment_type', 'last_update_year']
+    map_df = df_final.astype({col: object for col in na_cols})
+    map_df[na_cols] = map_df[na_cols].fillna('N/A')
+    create_interactive_map_with_sidebar(map_df, MAP_OUTPUT_HTML, MAP_DATA_JSON)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
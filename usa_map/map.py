@@ -1,22 +1,34 @@
-import json
+import base64
+import gzip
 import re
 import time
 import os
+import shutil
+import numpy as np
 import pandas as pd
 import requests
 import folium
+import ijson
+import orjson
+import pyarrow as pa
+from pyarrow import csv as pacsv
 from folium.plugins import HeatMap
-from collections import defaultdict
 from branca.element import Element
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
 API_BASE_URL = "https://clinicaltrials.gov/api/v2/studies"
 SEARCH_KEYWORD = 'fitzpatrick'
 COUNTRY_TO_ISOLATE = "United States"
+API_TIMEOUT = (3, 30) # (connect, read) seconds
 
-RAW_JSON_FILENAME = "usa_map/fitzpatrick_usa_search.json"
+RAW_JSON_FILENAME = "usa_map/fitzpatrick_usa_search.json" # Legacy single-document download, still read if present
+RAW_NDJSON_FILENAME = "usa_map/fitzpatrick_usa_search.ndjson"
 FINAL_OUTPUT_CSV = "usa_map/usa_fitzpatrick_trials_dataset.csv"
 MAP_OUTPUT_HTML = "index.html"
+WRITE_GZIP_COPIES = True # Also write a precompressed .gz copy of the map page for gzip-aware servers
 
 # --- Filter Configuration ---
 FILTERS = {
@@ -30,15 +42,21 @@ FILTERS = {
 }
 
 
+def _create_api_session():
+    """Creates a keep-alive HTTP session that retries throttled or failed requests with backoff."""
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    session = requests.Session()
+    session.headers.update({'Accept': 'application/json'})
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry))
+    return session
+
+API_SESSION = _create_api_session()
+
 def fetch_clinical_trials_data(api_url, keyword, output_filename):
     """
     Searches the ClinicalTrials.gov API for studies matching a keyword
-    and saves the raw results to a JSON file.
+    and saves the raw results as NDJSON (one study per line).
     """
-    if os.path.exists(output_filename):
-        print(f"[*] Raw data file '{output_filename}' already exists. Skipping download.")
-        return
-
     all_studies = []
     page_count = 1
     next_page_token = None
@@ -51,7 +69,7 @@ def fetch_clinical_trials_data(api_url, keyword, output_filename):
         try:
             if next_page_token:
                 params['pageToken'] = next_page_token
-            response = requests.get(api_url, params=params)
+            response = API_SESSION.get(api_url, params=params, timeout=API_TIMEOUT)
             response.raise_for_status()
             data = response.json()
             current_studies = data.get('studies', [])
@@ -68,23 +86,61 @@ def fetch_clinical_trials_data(api_url, keyword, output_filename):
 
     if all_studies:
         print(f"\n[*] Saving {len(all_studies)} total studies to '{output_filename}'...")
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            json.dump({'studies': all_studies}, f, ensure_ascii=False, indent=2)
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        with open(output_filename, 'wb') as f:
+            for study in all_studies:
+                f.write(orjson.dumps(study) + b'\n')
         print(f"[*] Successfully saved raw data.")
     else:
         print("\n[!] No studies were found to save.")
 
 
+# Patterns shared by every study, compiled once at import time
+_EXCLUSION_RE = re.compile(r'exclusion', re.IGNORECASE)
+_SENTENCE_SPLIT_RE = re.compile(r'[.\n]')
+_NUMERAL_PATTERN = r'\b(vi|v|iv|iii|ii|i|l|[1-6])\b'
+_NUMERAL_RE = re.compile(_NUMERAL_PATTERN, re.IGNORECASE)
+_RANGE_RE = re.compile(rf'{_NUMERAL_PATTERN}\s*(?:-|to|through)\s*{_NUMERAL_PATTERN}', re.IGNORECASE)
+_NUMERAL_CHARS = frozenset('123456ivl') # An ASCII sentence without any of these can't match either pattern
+_ROMAN_TO_INT = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6}
+_INT_TO_ROMAN = {v: k for k, v in _ROMAN_TO_INT.items()}
+
+@lru_cache(maxsize=None)
+def _numeral_to_int(s):
+    """Converts a matched numeral (Roman, Arabic, or an 'l' typo for 'I') to an integer."""
+    s_upper = s.upper()
+    if s_upper == 'L':
+        return 1
+    return int(s) if s.isdigit() else _ROMAN_TO_INT.get(s_upper)
+
+def iter_raw_studies(ndjson_filename, json_filename):
+    """
+    Yields raw study records one at a time so the full download is never held in memory.
+    Prefers the NDJSON download and falls back to streaming the legacy {'studies': [...]} JSON file.
+    """
+    if os.path.exists(ndjson_filename):
+        with open(ndjson_filename, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+    else:
+        with open(json_filename, 'rb') as f:
+            yield from ijson.items(f, 'studies.item', use_float=True)
+
+
 def parse_eligibility_criteria(study_record, keyword):
     """Finds sentences mentioning a keyword in the eligibility criteria."""
     eligibility_text = study_record.get('protocolSection', {}).get('eligibilityModule', {}).get('eligibilityCriteria', '')
     if not eligibility_text: return []
-    parts = re.split(r'exclusion', eligibility_text, flags=re.IGNORECASE)
+    parts = _EXCLUSION_RE.split(eligibility_text)
     found_sentences = []
     for text_part, is_exclusion in [(parts[0], False), (parts[1] if len(parts) > 1 else "", True)]:
         if not text_part: continue
-        for sentence in re.split(r'[.\n]', text_part):
-            if keyword in sentence.lower() and sentence.strip():
+        # Each half is lowercased once; splitting both copies on the same delimiters keeps the sentences aligned
+        lowered_part = text_part.lower()
+        if keyword not in lowered_part: continue
+        for sentence, lowered in zip(_SENTENCE_SPLIT_RE.split(text_part), _SENTENCE_SPLIT_RE.split(lowered_part)):
+            if keyword in lowered and sentence.strip():
                 found_sentences.append({'sentence': sentence.strip(), 'is_exclusion': is_exclusion})
     return found_sentences
 
@@ -94,40 +150,31 @@ def extract_and_standardize_scores(sentence):
     if not isinstance(sentence, str): return {}
     text = sentence.lower()
     result = {'extracted_score': 'Not Specified', 'Type_I': 0, 'Type_II': 0, 'Type_III': 0, 'Type_IV': 0, 'Type_V': 0, 'Type_VI': 0}
-    if any(word in text for word in ['wrinkle']):
+    if 'wrinkle' in text:
         result['extracted_score'] = 'Not a Skin Type Score'
         return result
     if 'all' in text or 'any' in text:
         result.update({k: 1 for k in result if k.startswith('Type_')})
         result['extracted_score'] = 'All'
         return result
+    if text.isascii() and _NUMERAL_CHARS.isdisjoint(text): # case-insensitive matching also accepts non-ASCII look-alikes such as 'ı'
+        return result
 
-    roman_map = {'I': 1, 'II': 2, 'III': 3, 'IV': 4, 'V': 5, 'VI': 6}
-    to_roman_map = {v: k for k, v in roman_map.items()}
-    
-    def _to_int(s):
-        s_upper = s.upper()
-        if s_upper == 'L':
-            return 1
-        return int(s) if s.isdigit() else roman_map.get(s_upper)
-
-    valid_numeral_pattern = r'\b(vi|v|iv|iii|ii|i|l|[1-6])\b'
-    range_pattern = f'{valid_numeral_pattern}\\s*(?:-|to|through)\\s*{valid_numeral_pattern}'
-    range_match = re.search(range_pattern, text, re.IGNORECASE)
+    range_match = _RANGE_RE.search(text)
 
     if range_match:
         start_str, end_str = range_match.groups()
-        start_num, end_num = _to_int(start_str), _to_int(end_str)
+        start_num, end_num = _numeral_to_int(start_str), _numeral_to_int(end_str)
         if start_num is not None and end_num is not None and start_num < end_num:
             for i in range(start_num, end_num + 1):
-                if i in to_roman_map: result[f"Type_{to_roman_map[i]}"] = 1
-            result['extracted_score'] = f"{to_roman_map.get(start_num, '')}-{to_roman_map.get(end_num, '')}"
+                if i in _INT_TO_ROMAN: result[f"Type_{_INT_TO_ROMAN[i]}"] = 1
+            result['extracted_score'] = f"{_INT_TO_ROMAN.get(start_num, '')}-{_INT_TO_ROMAN.get(end_num, '')}"
     else:
-        numerals_found = re.findall(valid_numeral_pattern, text, re.IGNORECASE)
-        scores = sorted(list(set(_to_int(n) for n in numerals_found if _to_int(n) is not None)))
+        numerals_found = _NUMERAL_RE.findall(text)
+        scores = sorted(list(set(_numeral_to_int(n) for n in numerals_found if _numeral_to_int(n) is not None)))
         roman_scores = []
         for score in scores:
-            roman_version = to_roman_map.get(score)
+            roman_version = _INT_TO_ROMAN.get(score)
             if roman_version:
                 result[f"Type_{roman_version}"] = 1
                 roman_scores.append(roman_version)
@@ -147,6 +194,16 @@ def extract_study_details(study_record, country):
     }
     protocol = study_record.get('protocolSection', {})
     if not protocol: return details
+
+    # Studies without a geocoded site in the country never reach the map, so nothing else is parsed for them
+    for loc in protocol.get('contactsLocationsModule', {}).get('locations', []):
+        if loc.get('country') == country and loc.get('geoPoint'):
+            details['us_facilities'].append({
+                'facility': loc.get('facility', 'N/A'), 'city': loc.get('city', 'N/A'),
+                'state': loc.get('state', 'N/A'), 'zip': loc.get('zip', 'N/A'),
+                'latitude': loc.get('geoPoint', {}).get('lat'), 'longitude': loc.get('geoPoint', {}).get('lon')
+            })
+    if not details['us_facilities']: return details
     
     status_module = protocol.get('statusModule', {})
     details['status'] = status_module.get('overallStatus', 'N/A')
@@ -161,14 +218,6 @@ def extract_study_details(study_record, country):
         details['enrollment'] = enrollment_info['count']
         details['enrollment_type'] = enrollment_info.get('type', 'N/A')
 
-    for loc in protocol.get('contactsLocationsModule', {}).get('locations', []):
-        if loc.get('country') == country and loc.get('geoPoint'):
-            details['us_facilities'].append({
-                'facility': loc.get('facility', 'N/A'), 'city': loc.get('city', 'N/A'),
-                'state': loc.get('state', 'N/A'), 'zip': loc.get('zip', 'N/A'),
-                'latitude': loc.get('geoPoint', {}).get('lat'), 'longitude': loc.get('geoPoint', {}).get('lon')
-            })
-
     results_section = study_record.get('resultsSection', {})
     if results_section:
         for measure in results_section.get('baselineCharacteristicsModule', {}).get('measures', []):
@@ -176,10 +225,29 @@ def extract_study_details(study_record, country):
                 for cat in measure.get('classes', [{}])[0].get('categories', []):
                     race_title = cat.get('title')
                     if race_title:
-                        total_count = sum(int(m.get('value', 0)) for m in cat.get('measurements', []))
+                        total_count = sum([int(value) for m in cat.get('measurements') or () if (value := m.get('value'))])
                         details['race_data'][f"Race_{race_title.replace(' ', '_')}"] = total_count
     return details
 
+def _write_csv(df, filename):
+    """Writes a DataFrame to CSV with Arrow's native writer; mixed-type object columns are written as text."""
+    mixed_cols = df.columns[df.dtypes == object]
+    table = pa.Table.from_pandas(df.astype({col: str for col in mixed_cols}), preserve_index=False)
+    pacsv.write_csv(table, filename)
+
+def _to_base64(values, dtype):
+    """Packs numbers into a typed-array buffer of the given numpy dtype and base64-encodes it for the page's JavaScript."""
+    return base64.b64encode(np.asarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+def _to_js_literal(value):
+    """Serializes a Python value to a compact JSON literal for embedding in the page's JavaScript."""
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+def _write_gzip_copy(path):
+    """Writes a precompressed copy of a generated file alongside it as '<path>.gz'."""
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb', compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst)
+
 def create_interactive_map_with_sidebar(map_data, filename):
     """Creates an interactive Folium map with a custom sidebar that
     controls switching between individual markers and a heatmap."""
@@ -202,28 +270,45 @@ def create_interactive_map_with_sidebar(map_data, filename):
         if record.get('latitude') is not None and record.get('longitude') is not None
     ]
     
-    locations_data = defaultdict(list)
-    for record in map_data:
-        lat, lon = record.get('latitude'), record.get('longitude')
-        if lat is not None and lon is not None:
-            key = f"{float(lat):.6f},{float(lon):.6f}"
-            locations_data[key].append(record)
+    # Located records are laid out column by column (structure of arrays): each field is one list
+    # indexed by record, records sharing coordinates point at the same location index, and
+    # repeated strings become indexes into lookup tables
+    located_records = [record for record in map_data if record.get('latitude') is not None and record.get('longitude') is not None]
+    location_ids = {}
+    record_locations = []
+    for record in located_records:
+        key = (round(record['latitude'] * 1e6), round(record['longitude'] * 1e6)) # coordinates in micro-degrees
+        record_locations.append(location_ids.setdefault(key, len(location_ids)))
+    location_coords = [(lat / 1e6, lon / 1e6) for lat, lon in location_ids]
+
+    string_tables = {}
+    def _table_ids(field, values):
+        table = string_tables.setdefault(field, {})
+        return [table.setdefault(value, len(table)) for value in values]
 
     heatmap_gradient = {0.4: 'blue', 0.6: 'lime', 0.8: 'yellow', 1.0: 'red'}
 
     all_race_columns = sorted([col for col in map_data[0].keys() if col.startswith('Race_')]) if map_data else []
-    enrollment_values = [r.get('enrollment') for r in map_data if isinstance(r.get('enrollment'), (int, float)) and r.get('enrollment') > 0]
-    max_enrollment = max(enrollment_values) if enrollment_values else 1000
-    year_values = sorted([int(r['last_update_year']) for r in map_data if r.get('last_update_year', 'N/A').isdigit()])
+    # Slider ranges and checkbox options are gathered in one pass over the records
+    max_enrollment, year_values, statuses, study_ids = 0, [], set(), set()
+    race_max = dict.fromkeys(all_race_columns, 0)
+    for r in map_data:
+        enrollment = r.get('enrollment')
+        if isinstance(enrollment, (int, float)) and enrollment > max_enrollment: max_enrollment = enrollment
+        year = r.get('last_update_year', 'N/A')
+        if year.isdigit(): year_values.append(int(year))
+        statuses.add(r.get('status', 'N/A'))
+        study_ids.add(r['nctId'])
+        for col in all_race_columns:
+            value = r.get(col)
+            if isinstance(value, (int, float)) and value > race_max[col]: race_max[col] = value
+    max_enrollment = max_enrollment or 1000
     min_year, max_year = (min(year_values), max(year_values)) if year_values else (2000, 2025)
-    all_statuses = sorted(set(r.get('status', 'N/A') for r in map_data))
+    all_statuses = sorted(statuses)
     status_display_map = { 'ACTIVE_NOT_RECRUITING': 'Active, not recruiting', 'COMPLETED': 'Completed', 'ENROLLING_BY_INVITATION': 'Enrolling by invitation', 'NOT_YET_RECRUITING': 'Not yet recruiting', 'RECRUITING': 'Recruiting', 'SUSPENDED': 'Suspended', 'TERMINATED': 'Terminated', 'WITHDRAWN': 'Withdrawn', 'AVAILABLE': 'Available', 'NO_LONGER_AVAILABLE': 'No longer available', 'TEMPORARILY_NOT_AVAILABLE': 'Temporarily not available', 'APPROVED_FOR_MARKETING': 'Approved for marketing', 'WITHHELD': 'Withheld', 'UNKNOWN': 'Unknown status', 'N/A': 'N/A' }
-    total_studies = len(set(record['nctId'] for record in map_data))
-    total_locations = len(locations_data)
-    race_data = {}
-    for col in all_race_columns:
-        values = [r.get(col, 0) for r in map_data if isinstance(r.get(col), (int, float)) and r.get(col) > 0]
-        if values: race_data[col] = { 'min': 0, 'max': max(values), 'display_name': col.replace('Race_', '').replace('_', ' ') }
+    total_studies = len(study_ids)
+    total_locations = len(location_ids)
+    race_data = { col: { 'min': 0, 'max': race_max[col], 'display_name': col.replace('Race_', '').replace('_', ' ') } for col in all_race_columns if race_max[col] > 0 }
     
     css_rules = """
         body { margin: 0; padding: 0; font-family: 'Segoe UI', sans-serif; }
@@ -251,7 +336,7 @@ def create_interactive_map_with_sidebar(map_data, filename):
     
     type_colors = {'I': '#FFE5E5', 'II': '#FFB3B3', 'III': '#FF8080', 'IV': '#CC6600', 'V': '#8B4513', 'VI': '#654321'}
     skin_type_html = ''.join([ f'<div class="skin-type-item active" data-type="{skin_type}" onclick="this.classList.toggle(\'active\'); updateFilters();"><div class="color-indicator" style="background-color: {color};"></div><span>Type {skin_type}</span></div>' for skin_type, color in type_colors.items() ])
-    race_filter_html = ''.join([ f'<div class="race-filter"><label for="{race_col.lower()}">{data["display_name"]}:</label><input type="range" id="{race_col.lower()}" class="slider" min="0" max="{data["max"]}" value="0" oninput="updateFilters()"><div class="slider-value" id="{race_col.lower()}-value">0+</div></div>' for race_col, data in race_data.items() ])
+    race_filter_html = ''.join([ f'<div class="race-filter"><label for="{race_col.lower()}">{data["display_name"]}:</label><input type="range" id="{race_col.lower()}" class="slider" min="0" max="{data["max"]}" value="0" oninput="onSliderInput(this)"><div class="slider-value" id="{race_col.lower()}-value">0+</div></div>' for race_col, data in race_data.items() ])
     status_checkboxes = ''.join([ f'<div class="checkbox-item"><input type="checkbox" id="status-{status.lower()}" checked onchange="updateFilters()"><label for="status-{status.lower()}">{status_display_map.get(status, status)}</label></div>' for status in all_statuses ])
 
     viz_switcher_html = """
@@ -281,92 +366,171 @@ def create_interactive_map_with_sidebar(map_data, filename):
         <div class="filter-section"><h3>Fitzpatrick Skin Types</h3>{skin_type_html}</div>
         <div class="filter-section">
             <h3>Enrollment</h3>
-            <div class="control-group"><label for="min-enrollment">Minimum Enrollment:</label><input type="range" id="min-enrollment" class="slider" min="0" max="{max_enrollment}" value="0" oninput="updateFilters()"><div class="slider-value" id="min-enrollment-value">0+</div></div>
+            <div class="control-group"><label for="min-enrollment">Minimum Enrollment:</label><input type="range" id="min-enrollment" class="slider" min="0" max="{max_enrollment}" value="0" oninput="onSliderInput(this)"><div class="slider-value" id="min-enrollment-value">0+</div></div>
             <div class="control-group" style="margin-top: 15px;"><label style="display: block; margin-bottom: 8px;">Enrollment Type:</label><div class="checkbox-group"><div class="checkbox-item"><input type="checkbox" id="enrollment-actual" checked onchange="updateFilters()"><label for="enrollment-actual">Actual</label></div><div class="checkbox-item"><input type="checkbox" id="enrollment-estimated" checked onchange="updateFilters()"><label for="enrollment-estimated">Estimated</label></div><div class="checkbox-item"><input type="checkbox" id="enrollment-na" checked onchange="updateFilters()"><label for="enrollment-na">N/A</label></div></div></div>
         </div>
         <div class="filter-section"><h3>Study Status</h3><div class="checkbox-group">{status_checkboxes}</div></div>
         <div class="filter-section">
             <h3>Last Updated Year</h3>
-            <div class="control-group"><label for="year-range">Minimum Year:</label><input type="range" id="year-range" class="slider" min="{min_year}" max="{max_year}" value="{min_year}" oninput="updateFilters()"><div class="slider-value" id="year-range-value">{min_year}+</div></div>
+            <div class="control-group"><label for="year-range">Minimum Year:</label><input type="range" id="year-range" class="slider" min="{min_year}" max="{max_year}" value="{min_year}" oninput="onSliderInput(this)"><div class="slider-value" id="year-range-value">{min_year}+</div></div>
         </div>
         <div class="filter-section"><h3>Race Demographics</h3>{race_filter_html}</div>
         <div class="filter-section"><button class="reset-btn" onclick="resetAllFilters()">Reset All Filters</button></div>
     </div>
     """
     
-    # The rest of the function (the javascript_code string) remains exactly the same
-    javascript_code = f"""
-        let mapInstance;
-        let markersLayer;
-        let heatmapLayer;
-
-        const locationsData = {json.dumps(locations_data)};
-        const heatmapData = {json.dumps(heatmap_data)};
-        const heatmapGradient = {json.dumps(heatmap_gradient)};
-        const allRaceColumns = {json.dumps(all_race_columns)};
-        const raceDataInfo = {json.dumps(race_data)};
-        const totalStudies = {total_studies};
-        const totalLocations = {total_locations};
-        const maxEnrollment = {max_enrollment};
-        const allStatuses = {json.dumps(all_statuses)};
-        const statusDisplayMap = {json.dumps(status_display_map)};
-        const minYear = {min_year};
-        const maxYear = {max_year};
-
-        function findMapInstance() {{ return window[document.querySelector('.folium-map').id]; }}
-        window.addEventListener('load', function() {{ setTimeout(initializeMap, 500); }});
-
-        function initializeMap() {{
+    # --- JavaScript ---
+    # Data constants are serialized once and joined onto the static filtering logic, so the
+    # logic below is a plain string with ordinary JS braces
+    # Numeric columns ship as base64 typed-array buffers; 'N/A' enrollments and years are stored
+    # as 0, with a flag kept for enrollments since 0 is a real count there
+    enrollments = [record.get('enrollment') for record in located_records]
+    record_enrollment_known = [enrollment != 'N/A' for enrollment in enrollments]
+    js_constants = {
+        'recordLocationsB64': _to_base64(record_locations, '<i4'),
+        'locationLatsB64': _to_base64([lat for lat, _ in location_coords], '<f4'),
+        'locationLonsB64': _to_base64([lon for _, lon in location_coords], '<f4'),
+        'recordNctIdsB64': _to_base64(_table_ids('nctId', [record['nctId'] for record in located_records]), '<i4'),
+        'recordStatusesB64': _to_base64(_table_ids('status', [record.get('status', 'N/A') for record in located_records]), '<u1'),
+        'recordFacilitiesB64': _to_base64(_table_ids('facility', [record.get('facility') for record in located_records]), '<i4'),
+        'recordCitiesB64': _to_base64(_table_ids('city', [record.get('city') for record in located_records]), '<i4'),
+        'recordEnrollmentsB64': _to_base64([enrollment if known else 0 for enrollment, known in zip(enrollments, record_enrollment_known)], '<i4'),
+        'recordEnrollmentKnownB64': _to_base64(record_enrollment_known, '<u1'),
+        'recordEnrollmentTypesB64': _to_base64(_table_ids('enrollment_type', [record.get('enrollment_type') for record in located_records]), '<u1'),
+        'recordYearsB64': _to_base64([int(year) if str(year).isdigit() else 0 for year in (record.get('last_update_year') for record in located_records)], '<u2'),
+        'recordTypeMasksB64': _to_base64([sum(1 << bit for bit, roman in enumerate(['I', 'II', 'III', 'IV', 'V', 'VI']) if record.get(f'Type_{roman}') == 1) for record in located_records], '<u1'),
+        'raceCountsB64': _to_base64([[record.get(col, 0) for record in located_records] for col in all_race_columns], '<i4'), # one row per race column
+        'nctIdTable': list(string_tables['nctId']),
+        'statusTable': list(string_tables['status']),
+        'enrollmentTypeTable': list(string_tables['enrollment_type']),
+        'facilityTable': list(string_tables['facility']),
+        'cityTable': list(string_tables['city']),
+        'heatmapB64': _to_base64(heatmap_data, '<f4'),
+        'heatmapGradient': heatmap_gradient,
+        'allRaceColumns': all_race_columns,
+        'raceDataInfo': race_data,
+        'totalStudies': total_studies,
+        'totalLocations': total_locations,
+        'maxEnrollment': max_enrollment,
+        'allStatuses': all_statuses,
+        'statusDisplayMap': status_display_map,
+        'minYear': min_year,
+        'maxYear': max_year,
+    }
+    javascript_logic = """
+        function decodeBase64(b64, ArrayType) {
+            const bin = atob(b64);
+            const bytes = new Uint8Array(bin.length);
+            for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+            return new ArrayType(bytes.buffer);
+        }
+        const recordLocations = decodeBase64(recordLocationsB64, Int32Array);
+        const locationLats = decodeBase64(locationLatsB64, Float32Array);
+        const locationLons = decodeBase64(locationLonsB64, Float32Array);
+        const recordNctIds = decodeBase64(recordNctIdsB64, Int32Array);
+        const recordStatuses = decodeBase64(recordStatusesB64, Uint8Array);
+        const recordFacilities = decodeBase64(recordFacilitiesB64, Int32Array);
+        const recordCities = decodeBase64(recordCitiesB64, Int32Array);
+        const recordEnrollments = decodeBase64(recordEnrollmentsB64, Int32Array);
+        const recordEnrollmentKnown = decodeBase64(recordEnrollmentKnownB64, Uint8Array);
+        const recordEnrollmentTypes = decodeBase64(recordEnrollmentTypesB64, Uint8Array);
+        const recordYears = decodeBase64(recordYearsB64, Uint16Array);
+        const recordTypeMasks = decodeBase64(recordTypeMasksB64, Uint8Array);
+        const raceCounts = decodeBase64(raceCountsB64, Int32Array);
+        const numRecords = recordLocations.length;
+        const heatmapValues = decodeBase64(heatmapB64, Float32Array);
+        const heatmapData = [];
+        for (let i = 0; i < heatmapValues.length; i += 2) heatmapData.push([heatmapValues[i], heatmapValues[i + 1]]);
+
+        function findMapInstance() { return window[document.querySelector('.folium-map').id]; }
+        window.addEventListener('load', function() { setTimeout(initializeMap, 500); });
+
+        function initializeMap() {
             mapInstance = findMapInstance();
-            if (!mapInstance) {{ console.error("Map instance not found. Retrying..."); setTimeout(initializeMap, 500); return; }}
+            if (!mapInstance) { console.error("Map instance not found. Retrying..."); setTimeout(initializeMap, 500); return; }
             
             markersLayer = L.layerGroup();
-            heatmapLayer = L.heatLayer(heatmapData, {{ 
+            // One marker per location, created once and drawn on a shared canvas; filtering only restyles them
+            const renderer = L.canvas();
+            locationMarkers = Array.from(locationLats, (lat, loc) => L.circleMarker([lat, locationLons[loc]], { renderer, color: '#ffffff', weight: 2, fillColor: '#764ba2', fillOpacity: 0.8 })
+                .bindPopup('', {maxWidth: 400})
+                .bindTooltip(''));
+            heatmapLayer = L.heatLayer(heatmapData, { 
                 radius: 25, 
                 blur: 15,
                 gradient: heatmapGradient 
-            }});
+            });
 
             updateVisualization();
             updateFilters();
-        }}
+        }
         
-        window.updateVisualization = function() {{
+        window.updateVisualization = function() {
             const vizType = document.querySelector('input[name="viz-type"]:checked').value;
-            if (vizType === 'dots') {{
-                if (mapInstance.hasLayer(heatmapLayer)) {{
+            if (vizType === 'dots') {
+                if (mapInstance.hasLayer(heatmapLayer)) {
                     mapInstance.removeLayer(heatmapLayer);
-                }}
-                if (!mapInstance.hasLayer(markersLayer)) {{
+                }
+                if (!mapInstance.hasLayer(markersLayer)) {
                     mapInstance.addLayer(markersLayer);
-                }}
-            }} else {{ // heatmap
-                if (mapInstance.hasLayer(markersLayer)) {{
+                }
+            } else { // heatmap
+                if (mapInstance.hasLayer(markersLayer)) {
                     mapInstance.removeLayer(markersLayer);
-                }}
-                if (!mapInstance.hasLayer(heatmapLayer)) {{
+                }
+                if (!mapInstance.hasLayer(heatmapLayer)) {
                     mapInstance.addLayer(heatmapLayer);
-                }}
-            }}
-        }}
-
-        function passesFilters(record, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypes, yearFilter) {{
-            let hasActiveSkinType = activeTypes.some(type => record[`Type_${{type}}`] === 1);
-            if (!hasActiveSkinType) return false;
-            const recordYear = parseInt(record.last_update_year);
-            if (!isNaN(recordYear) && recordYear < yearFilter) return false;
-            const enrollment = record.enrollment === 'N/A' ? 0 : record.enrollment;
-            if (enrollment < enrollmentFilter) return false;
-            if (!enrollmentTypes.includes((record.enrollment_type || 'N/A').toUpperCase())) return false;
-            if (!statusTypes.includes(record.status || 'N/A')) return false;
-            for (const [raceCol, minVal] of Object.entries(raceFilters)) {{
-                if ((record[raceCol] || 0) < minVal) return false;
-            }}
+                }
+            }
+        }
+
+        const skinTypes = ['I', 'II', 'III', 'IV', 'V', 'VI'];
+
+        // Skin types are packed into a 6-bit mask per record (bit 0 = Type I ... bit 5 = Type VI)
+        function passesFilters(i, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypeMask, yearFilter) {
+            if (!(recordTypeMasks[i] & activeTypeMask)) return false;
+            if (recordYears[i] !== 0 && recordYears[i] < yearFilter) return false; // 0 = unknown year
+            if (recordEnrollments[i] < enrollmentFilter) return false;
+            if (!enrollmentTypes.includes((enrollmentTypeTable[recordEnrollmentTypes[i]] || 'N/A').toUpperCase())) return false;
+            if (!statusTypes.includes(statusTable[recordStatuses[i]] || 'N/A')) return false;
+            for (const [raceCol, minVal] of Object.entries(raceFilters)) {
+                if (raceCounts[allRaceColumns.indexOf(raceCol) * numRecords + i] < minVal) return false;
+            }
             return true;
-        }}
-
-        window.updateFilters = function() {{
-            if (!mapInstance || !markersLayer) {{ console.warn('Map or layers not ready for update.'); return; }}
+        }
+
+        // A study's popup section never depends on the filters, so it is built the first time its
+        // location is shown and reused on every later update
+        const recordPopupHtml = [];
+        function buildStudyPopupHtml(recordIdx) {
+            let raceHtml = "";
+            allRaceColumns.forEach((raceCol, raceIdx) => { const count = raceCounts[raceIdx * numRecords + recordIdx]; if (count > 0) raceHtml += `<li>${raceDataInfo[raceCol]?.display_name || raceCol}: <strong>${count}</strong></li>`; });
+            if (raceHtml) raceHtml = `<p style="margin:5px 0 3px;"><strong>Demographics:</strong></p><ul style="margin:0;padding-left:20px;">${raceHtml}</ul>`;
+            const nctId = nctIdTable[recordNctIds[recordIdx]], enrollment = recordEnrollmentKnown[recordIdx] ? recordEnrollments[recordIdx] : 'N/A', enrollmentType = enrollmentTypeTable[recordEnrollmentTypes[recordIdx]];
+            const enrollmentDisplay = enrollment !== 'N/A' && enrollmentType !== 'N/A' ? `${enrollment} (${enrollmentType})` : (enrollment || 'N/A');
+            const status = statusTable[recordStatuses[recordIdx]];
+            const statusDisplay = statusDisplayMap[status] || status;
+            const includedSkinTypes = skinTypes.filter((roman, bit) => recordTypeMasks[recordIdx] >> bit & 1);
+            const skinTypeDisplay = includedSkinTypes.length > 0 ? includedSkinTypes.join(', ') : 'Not Specified';
+            const lastUpdateYearDisplay = recordYears[recordIdx] || 'N/A';
+            return `<h4 style="margin:0 0 10px 0;">Study Details</h4><p><strong>NCT ID:</strong> <a href="https://clinicaltrials.gov/study/${nctId}" target="_blank">${nctId}</a></p><p><strong>Status:</strong> ${statusDisplay}</p><p><strong>Last Updated:</strong> ${lastUpdateYearDisplay}</p><p><strong>Enrollment:</strong> <strong>${enrollmentDisplay}</strong></p><p><strong>Facility:</strong> ${facilityTable[recordFacilities[recordIdx]]}</p><p><strong>Skin Types:</strong> ${skinTypeDisplay}</p>${raceHtml}`;
+        }
+
+        // Slider drags fire many input events per frame; they are coalesced into one update per animation frame
+        let updatePending = false;
+        window.scheduleUpdate = function() {
+            if (updatePending) return;
+            updatePending = true;
+            requestAnimationFrame(() => { updatePending = false; updateFilters(); });
+        };
+        // The slider's own label is updated right away; only the marker rebuild waits for the frame
+        window.onSliderInput = function(slider) {
+            document.getElementById(slider.id + '-value').textContent = slider.value + '+';
+            scheduleUpdate();
+        };
+
+        window.updateFilters = function() {
+            if (!mapInstance || !markersLayer) { console.warn('Map or layers not ready for update.'); return; }
 
             const activeTypes = Array.from(document.querySelectorAll('.skin-type-item.active')).map(el => el.dataset.type);
             const enrollmentFilter = parseInt(document.getElementById('min-enrollment').value);
@@ -377,45 +541,50 @@ def create_interactive_map_with_sidebar(map_data, filename):
             if (document.getElementById('enrollment-actual').checked) enrollmentTypes.push('ACTUAL');
             if (document.getElementById('enrollment-estimated').checked) enrollmentTypes.push('ESTIMATED');
             if (document.getElementById('enrollment-na').checked) enrollmentTypes.push('N/A');
-            const statusTypes = allStatuses.filter(status => document.getElementById(`status-${{status.toLowerCase()}}`)?.checked);
-            const raceFilters = {{}};
-            for (const raceCol in raceDataInfo) {{
+            const statusTypes = allStatuses.filter(status => document.getElementById(`status-${status.toLowerCase()}`)?.checked);
+            const raceFilters = {};
+            for (const raceCol in raceDataInfo) {
                 const elId = raceCol.toLowerCase();
                 const element = document.getElementById(elId);
-                if (element) {{ const minValue = parseInt(element.value); raceFilters[raceCol] = minValue; document.getElementById(elId + '-value').textContent = minValue + '+'; }}
-            }}
+                if (element) { const minValue = parseInt(element.value); raceFilters[raceCol] = minValue; document.getElementById(elId + '-value').textContent = minValue + '+'; }
+            }
 
-            markersLayer.clearLayers();
             let visibleLocations = 0;
             const visibleStudies = new Set();
 
-            for (const [locKey, studiesAtLoc] of Object.entries(locationsData)) {{
-                const passingStudies = studiesAtLoc.filter(study => passesFilters(study, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypes, yearFilter));
-                if (passingStudies.length > 0) {{
+            // Passing record indexes are grouped by location in one scan of the record arrays
+            const activeTypeMask = activeTypes.reduce((mask, type) => mask | (1 << skinTypes.indexOf(type)), 0);
+            const passingByLocation = [];
+            for (let i = 0; i < numRecords; i++) {
+                if (!passesFilters(i, enrollmentFilter, enrollmentTypes, statusTypes, raceFilters, activeTypeMask, yearFilter)) continue;
+                const loc = recordLocations[i];
+                (passingByLocation[loc] = passingByLocation[loc] || []).push(i);
+            }
+            for (let loc = 0; loc < locationMarkers.length; loc++) {
+                const passingStudies = passingByLocation[loc];
+                if (!passingStudies) {
+                    markersLayer.removeLayer(locationMarkers[loc]);
+                } else {
                     visibleLocations++;
-                    passingStudies.forEach(study => visibleStudies.add(study.nctId));
-                    const [lat, lon] = locKey.split(',').map(Number);
+                    passingStudies.forEach(recordIdx => visibleStudies.add(recordNctIds[recordIdx]));
                     let popupHtml = '<div style="font-family: Arial, sans-serif; max-height: 300px; overflow-y: auto; min-width: 350px;">';
-                    passingStudies.forEach((study, i) => {{
-                        let raceHtml = "";
-                        allRaceColumns.forEach(raceCol => {{ const count = study[raceCol] || 0; if (count > 0) raceHtml += `<li>${{raceDataInfo[raceCol]?.display_name || raceCol}}: <strong>${{count}}</strong></li>`; }});
-                        if (raceHtml) raceHtml = `<p style="margin:5px 0 3px;"><strong>Demographics:</strong></p><ul style="margin:0;padding-left:20px;">${{raceHtml}}</ul>`;
-                        const enrollmentDisplay = study.enrollment !== 'N/A' && study.enrollment_type !== 'N/A' ? `${{study.enrollment}} (${{study.enrollment_type}})` : (study.enrollment || 'N/A');
-                        const statusDisplay = statusDisplayMap[study.status] || study.status;
-                        const includedSkinTypes = ['I', 'II', 'III', 'IV', 'V', 'VI'].filter(roman => study[`Type_${{roman}}`] === 1);
-                        const skinTypeDisplay = includedSkinTypes.length > 0 ? includedSkinTypes.join(', ') : 'Not Specified';
-                        const lastUpdateYearDisplay = study.last_update_year || 'N/A';
-                        popupHtml += `<div style="border-top: ${{i > 0 ? '1px solid #ccc' : 'none'}}; padding: 10px 5px;"><h4 style="margin:0 0 10px 0;">Study Details</h4><p><strong>NCT ID:</strong> <a href="https://clinicaltrials.gov/study/${{study.nctId}}" target="_blank">${{study.nctId}}</a></p><p><strong>Status:</strong> ${{statusDisplay}}</p><p><strong>Last Updated:</strong> ${{lastUpdateYearDisplay}}</p><p><strong>Enrollment:</strong> <strong>${{enrollmentDisplay}}</strong></p><p><strong>Facility:</strong> ${{study.facility}}</p><p><strong>Skin Types:</strong> ${{skinTypeDisplay}}</p>${{raceHtml}}</div>`;
-                    }});
+                    passingStudies.forEach((recordIdx, i) => {
+                        const studyHtml = recordPopupHtml[recordIdx] || (recordPopupHtml[recordIdx] = buildStudyPopupHtml(recordIdx));
+                        popupHtml += `<div style="border-top: ${i > 0 ? '1px solid #ccc' : 'none'}; padding: 10px 5px;">${studyHtml}</div>`;
+                    });
                     popupHtml += '</div>';
-                    L.circleMarker([lat, lon], {{ radius: 6 + Math.sqrt(passingStudies.length), color: '#ffffff', weight: 2, fillColor: '#764ba2', fillOpacity: 0.8 }}).bindPopup(popupHtml, {{maxWidth: 400}}).bindTooltip(`${{passingStudies[0].city}} (${{passingStudies.length}} studies)`).addTo(markersLayer);
-                }}
-            }}
+                    locationMarkers[loc]
+                        .setRadius(6 + Math.sqrt(passingStudies.length))
+                        .setPopupContent(popupHtml)
+                        .setTooltipContent(`${cityTable[recordCities[passingStudies[0]]]} (${passingStudies.length} studies)`)
+                        .addTo(markersLayer);
+                }
+            }
             document.getElementById('visible-locations-count').textContent = visibleLocations;
             document.getElementById('visible-studies-count').textContent = visibleStudies.size;
-        }};
+        };
 
-        window.resetAllFilters = function() {{
+        window.resetAllFilters = function() {
             document.getElementById('viz-dots').checked = true;
             updateVisualization();
             document.querySelectorAll('.skin-type-item').forEach(item => item.classList.add('active'));
@@ -425,10 +594,13 @@ def create_interactive_map_with_sidebar(map_data, filename):
             document.getElementById('enrollment-actual').checked = true;
             document.getElementById('enrollment-estimated').checked = true;
             document.getElementById('enrollment-na').checked = true;
-            allStatuses.forEach(status => {{ const checkbox = document.getElementById(`status-${{status.toLowerCase()}}`); if (checkbox) checkbox.checked = true; }});
+            allStatuses.forEach(status => { const checkbox = document.getElementById(`status-${status.toLowerCase()}`); if (checkbox) checkbox.checked = true; });
             updateFilters();
-        }};
+        };
     """
+    javascript_code = "\n        let mapInstance;\n        let markersLayer;\n        let heatmapLayer;\n        let locationMarkers = [];\n\n" + "".join(
+        f"        const {name} = {_to_js_literal(value)};\n" for name, value in js_constants.items()
+    ) + javascript_logic
     
     m.get_root().header.add_child(Element(f"<style>{css_rules}</style>"))
     m.get_root().html.add_child(Element(sidebar_html))
@@ -436,59 +608,71 @@ def create_interactive_map_with_sidebar(map_data, filename):
     
     m.save(filename)
     print(f"\n[*] Success! Interactive map saved to '{filename}'.")
+    if WRITE_GZIP_COPIES:
+        _write_gzip_copy(filename)
+        print(f"[*] Wrote gzip copy '{filename}.gz'.")
 def main():
     """Main function to run the entire data processing and mapping pipeline."""
-    fetch_clinical_trials_data(API_BASE_URL, SEARCH_KEYWORD, RAW_JSON_FILENAME)
-    try:
-        with open(RAW_JSON_FILENAME, 'r', encoding='utf-8') as f: 
-            studies = json.load(f).get('studies', [])
-        print(f"[*] Loaded {len(studies)} studies from '{RAW_JSON_FILENAME}'.")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"[!] Error loading raw JSON file: {e}. Please run the script again.")
-        return
-
-    all_facility_rows = []
+    if os.path.exists(RAW_NDJSON_FILENAME) or os.path.exists(RAW_JSON_FILENAME):
+        print("[*] Raw data file already exists. Skipping download.")
+    else:
+        fetch_clinical_trials_data(API_BASE_URL, SEARCH_KEYWORD, RAW_NDJSON_FILENAME)
+    # Rows are collected as tuples in a fixed column order; race columns are only known once every study has been seen
+    skin_type_cols = [f'Type_{r}' for r in ['I', 'II', 'III', 'IV', 'V', 'VI']]
+    study_cols = ['nctId', 'status', 'enrollment', 'enrollment_type', 'last_update_year', 'extracted_score', *skin_type_cols]
+    facility_cols = ['facility', 'city', 'state', 'zip', 'latitude', 'longitude']
+    study_rows, study_races, facility_rows, facility_study_index = [], [], [], []
+    race_cols = {}
     all_race_keys = set(FILTERS.get('min_participants_by_race', {}).keys())
+    n_studies = 0
 
-    for study in studies:
-        nct_id = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', 'N/A')
-        details = extract_study_details(study, COUNTRY_TO_ISOLATE)
-        if not details['us_facilities']: continue
+    try:
+        for study in iter_raw_studies(RAW_NDJSON_FILENAME, RAW_JSON_FILENAME):
+            n_studies += 1
+            nct_id = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', 'N/A')
+            details = extract_study_details(study, COUNTRY_TO_ISOLATE)
+            if not details['us_facilities']: continue
         
-        for key in details['race_data']: all_race_keys.add(key)
+            for key in details['race_data']: all_race_keys.add(key)
         
-        inclusion_sentences = [s['sentence'] for s in parse_eligibility_criteria(study, SEARCH_KEYWORD) if not s['is_exclusion']]
-        if not inclusion_sentences: continue
+            inclusion_sentences = [s['sentence'] for s in parse_eligibility_criteria(study, SEARCH_KEYWORD) if not s['is_exclusion']]
+            if not inclusion_sentences: continue
         
-        score_data = extract_and_standardize_scores(inclusion_sentences[0])
-        if score_data['extracted_score'] == 'Not a Skin Type Score': continue
+            score_data = extract_and_standardize_scores(inclusion_sentences[0])
+            if score_data['extracted_score'] == 'Not a Skin Type Score': continue
             
-        for facility in details['us_facilities']:
-            row = {
-                'nctId': nct_id, 'status': details['status'], 
-                'enrollment': details['enrollment'], 
-                'enrollment_type': details['enrollment_type'],
-                'last_update_year': details['last_update_year']
-            }
-            row.update(score_data)
-            row.update(facility)
-            row.update(details['race_data'])
-            all_facility_rows.append(row)
+            facility_study_index.extend([len(study_rows)] * len(details['us_facilities']))
+            facility_rows.extend(tuple(facility[col] for col in facility_cols) for facility in details['us_facilities'])
+            study_rows.append((
+                nct_id, details['status'], details['enrollment'], details['enrollment_type'], details['last_update_year'],
+                score_data['extracted_score'], *(score_data[col] for col in skin_type_cols)
+            ))
+            study_races.append(details['race_data'])
+            race_cols.update(dict.fromkeys(details['race_data']))
+    except (FileNotFoundError, orjson.JSONDecodeError, ijson.JSONError) as e:
+        print(f"[!] Error loading raw data file: {e}. Please run the script again.")
+        return
+    print(f"[*] Loaded {n_studies} studies.")
     
-    if not all_facility_rows:
+    if not facility_rows:
         print("[!] No US-based studies with specified criteria and geo-coordinates found.")
         return
 
-    df = pd.DataFrame(all_facility_rows)
-    for race_col in all_race_keys:
-        if race_col not in df.columns: df[race_col] = 0
+    # Study-level fields are tabulated once per study and spread over that study's facilities by position
+    studies_df = pd.DataFrame.from_records(study_rows, columns=study_cols)
+    races_df = pd.DataFrame.from_records([tuple(races.get(col) for col in race_cols) for races in study_races], columns=list(race_cols), index=pd.RangeIndex(len(study_races)))
+    df = pd.concat([
+        studies_df.take(facility_study_index).reset_index(drop=True),
+        pd.DataFrame.from_records(facility_rows, columns=facility_cols),
+        races_df.take(facility_study_index).reset_index(drop=True),
+    ], axis=1)
+    df = df.reindex(columns=[*df.columns, *(col for col in all_race_keys if col not in df.columns)], fill_value=0)
     df['enrollment'] = df['enrollment'].replace(0, 'N/A')
     df.fillna({'enrollment': 'N/A'}, inplace=True)
     df.fillna(0, inplace=True)
     print(f"[*] Processed data into {len(df)} facility-level records.")
 
     print("\n[*] Identifying studies that passed initial parsing but have no specific score assigned...")
-    skin_type_cols = [f'Type_{r}' for r in ['I', 'II', 'III', 'IV', 'V', 'VI']]
     existing_skin_type_cols = [col for col in skin_type_cols if col in df.columns]
     
     unparsed_mask = df[existing_skin_type_cols].sum(axis=1) == 0
@@ -499,7 +683,7 @@ def main():
         print(f"✅ Found {len(unparsed_df)} records from {num_unparsed_studies} unique studies with no specific Fitzpatrick Type flags.")
         output_cols = ['nctId', 'facility', 'city', 'state', 'extracted_score']
         final_output_cols = [col for col in output_cols if col in unparsed_df.columns]
-        unparsed_df[final_output_cols].to_csv('usa_map/unparsed_studies.csv', index=False)
+        _write_csv(unparsed_df[final_output_cols], 'usa_map/unparsed_studies.csv')
         print(f"[*] This list has been saved to 'unparsed_studies.csv' for your review.")
     else:
         print("[*] All processed studies have at least one specific Fitzpatrick Type flag assigned.")
@@ -514,7 +698,7 @@ def main():
         return
 
     try:
-        df.to_csv(FINAL_OUTPUT_CSV, index=False, encoding='utf-8')
+        _write_csv(df, FINAL_OUTPUT_CSV)
         print(f"[*] Success! Final dataset saved to '{FINAL_OUTPUT_CSV}'.")
     except IOError as e: 
         print(f"[!] Error writing final CSV file: {e}")